@@ -7,6 +7,7 @@ import collections
 import itertools
 import shlex
 import logging
+import signal
 import sys
 from pathlib import Path
 
@@ -26,6 +27,10 @@ MODES = (
     "format",
     "generate",
     "repl",
+    "analyze",
+    "pgo",
+    "profile",
+    "stats",
 )
 
 
@@ -60,6 +65,9 @@ def parse_args():
     parser.add_argument("--cmd_enable", "-e", action="append", default=[])
     parser.add_argument("--cmd_disable", "-d", action="append", default=[])
     parser.add_argument("--build_dir", "-b", type=Path)
+    parser.add_argument("--jobs", "-j", type=int)
+    parser.add_argument("--container", action="store_true")
+    parser.add_argument("--release", action="store_true")
     parser.set_defaults(action=lambda m: m.build())
 
     subparsers = parser.add_subparsers()
@@ -108,7 +116,11 @@ def main():
     logging.basicConfig(level=logging.DEBUG if args.verbose > 0 else logging.INFO)
 
     tool = MBuildTool(args)
-    args.action(tool)
+    try:
+        args.action(tool)
+    except KeyboardInterrupt:
+        # the children were already stopped, exit like a shell does on Ctrl-C
+        return 128 + signal.SIGINT
     for e in tool.errors():
         if e:
             return e
@@ -1,56 +1,206 @@
-from multiprocessing import cpu_count
-from subprocess import run
+import hashlib
+import logging
+import os
+import shlex
+import shutil
+from .Process import run, PIPE, DEVNULL
 from .Base import plugin, BasePlugin, PluginSupport
+from .Cache import (
+    state_dir,
+    user_cache_dir,
+    load_json,
+    store_json,
+    digest_files,
+    source_files,
+)
+from . import ClangFormat
+from . import Progress
 from jinja2 import Environment, PackageLoader, select_autoescape
 
+LOGGER = logging.getLogger(__name__)
+
+# variables that change the results of configure's feature tests
+CACHE_VARIABLES = (
+    "CC",
+    "CXX",
+    "CPP",
+    "CFLAGS",
+    "CXXFLAGS",
+    "CPPFLAGS",
+    "LDFLAGS",
+    "LIBS",
+)
+# the compilers configure looks for when CC or CXX are unset
+DEFAULT_COMPILERS = {"CC": ("gcc", "cc"), "CXX": ("g++", "c++")}
+
+
+def _compiler_identity(name):
+    """returns the resolved path and version of the compiler in variable name, so an
+    upgrade behind the same CC=gcc does not reuse the feature tests of the old one"""
+    command = shlex.split(os.environ.get(name, ""))
+    candidates = command[:1] or DEFAULT_COMPILERS[name]
+    path = next(filter(None, map(shutil.which, candidates)), None)
+    if path is None:
+        return ""
+    path = os.path.realpath(path)
+    version = run(
+        [path, *command[1:], "--version"],
+        stdout=PIPE,
+        stderr=DEVNULL,
+        universal_newlines=True,
+    )
+    return f"{path}\0{os.stat(path).st_mtime_ns}\0{version.stdout}"
+
 
 @plugin
 class AutotoolsPlugin(BasePlugin):
+    @staticmethod
+    def uses_autoconf(settings):
+        """returns if the project is configured with autoconf rather than a plain makefile"""
+        repo_base = settings["repo_base"].value
+        return any(
+            (repo_base / name).exists()
+            for name in ("configure", "configure.ac", "autogen.sh")
+        )
+
+    @classmethod
+    def make_dir(cls, settings):
+        """returns the directory make runs in: build_dir for autoconf projects, unless
+        the source tree was already configured in-tree which prevents VPATH builds"""
+        repo_base = settings["repo_base"].value
+        if not cls.uses_autoconf(settings) or (repo_base / "config.status").exists():
+            return repo_base
+        return settings["build_dir"].value
+
+    @staticmethod
+    def cache_file(settings):
+        """returns the configure cache shared by the builds of a project with the same
+        compilers and flags"""
+        hasher = hashlib.sha256(f"{settings['repo_base'].value.resolve()}\0".encode())
+        for name in DEFAULT_COMPILERS:
+            hasher.update(f"{_compiler_identity(name)}\0".encode())
+        for name in CACHE_VARIABLES:
+            hasher.update(f"{name}={os.environ.get(name, '')}\0".encode())
+        for arg in settings["cmdline_configure"].value:
+            hasher.update(f"{arg}\0".encode())
+        return user_cache_dir("autoconf") / f"{hasher.hexdigest()[:16]}.cache"
+
+    @staticmethod
+    def inputs_digest(settings):
+        """hashes the files that configure and the makefiles are generated from"""
+        repo_base = settings["repo_base"].value
+        return digest_files(
+            source_files(repo_base, "configure.ac", "*Makefile.am", "*.m4")
+        )
+
+    def autogen(self, settings):
+        """regenerates configure from configure.ac"""
+        repo_base = settings["repo_base"].value
+        if (repo_base / "autogen.sh").exists():
+            return run(["./autogen.sh"], cwd=repo_base).returncode
+        return run(["autoreconf", "-fi"], cwd=repo_base).returncode
+
     def configure(self, settings):
-        if (
-            not (settings["repo_base"].value / "configure").exists()
-            and (settings["repo_base"].value / "autogen.sh").exists()
-        ):
-            run(["./autogen.sh"], cwd=settings["repo_base"].value)
+        """configures the build directory, reusing cached feature tests and only
+        rechecking when configure.ac or a Makefile.am changed"""
+        if not self.uses_autoconf(settings):
+            return 0
+        repo_base = settings["repo_base"].value
+        make_dir = self.make_dir(settings)
+        if make_dir == repo_base:
+            LOGGER.info("the source directory is configured in-tree, building there")
+        make_dir.mkdir(exist_ok=True)
+        state_path = state_dir(settings) / "autotools.json"
+        state = load_json(state_path, {})
+        digest = self.inputs_digest(settings)
 
-        if (
-            not (settings["repo_base"].value / "configure").exists()
-            and (settings["repo_base"].value / "configure").exists()
-        ):
-            args = ["./configure"]
-            args.extend(settings["cmdline_configure"].value)
-            return run(args, cwd=settings["repo_base"].value).returncode
+        if not (repo_base / "configure").exists():
+            returncode = self.autogen(settings)
+            if returncode != 0:
+                return returncode
 
-    def build(self, settings):
-        """compiles the source code or a subset thereof"""
-        self.configure(settings)
+        if (make_dir / "config.status").exists():
+            if state.get("inputs") == digest:
+                return 0
+            LOGGER.info("configure.ac or Makefile.am changed, rechecking")
+            if state.get("inputs") is not None:
+                returncode = self.autogen(settings)
+                if returncode != 0:
+                    return returncode
+            returncode = run(["./config.status", "--recheck"], cwd=make_dir).returncode
+            if returncode == 0:
+                returncode = run(["./config.status"], cwd=make_dir).returncode
+        else:
+            cache_file = self.cache_file(settings)
+            args = [
+                str(repo_base / "configure"),
+                f"--cache-file={cache_file}",
+                *settings["cmdline_configure"].value,
+            ]
+            returncode = run(args, cwd=make_dir).returncode
+            if returncode != 0 and cache_file.exists():
+                LOGGER.warning("configure failed, retrying without %s", cache_file)
+                cache_file.unlink()
+                returncode = run(args, cwd=make_dir).returncode
+
+        if returncode == 0:
+            # regenerating configure can rewrite inputs such as aclocal.m4
+            store_json(state_path, {"inputs": self.inputs_digest(settings)})
+        return returncode
+
+    def make(self, settings, *targets):
+        """configures if needed and runs make in the build directory with the shared
+        job budget"""
+        returncode = self.configure(settings)
+        if returncode:
+            return returncode
         return run(
-            ["make", "-j", str(cpu_count())], cwd=settings["repo_base"].value
+            ["make", "-j", str(settings["jobs"].value), *targets],
+            cwd=self.make_dir(settings),
         ).returncode
 
+    def build(self, settings):
+        """compiles the source code or a subset thereof"""
+        returncode = self.configure(settings)
+        if returncode:
+            return returncode
+        return Progress.run_with_eta(
+            [
+                "make",
+                "-j",
+                str(settings["jobs"].value),
+                *settings["cmdline_build"].value,
+            ],
+            settings,
+            "make",
+            cwd=self.make_dir(settings),
+        )
+
     def test(self, settings):
         """runs automated tests on source code or a subset there of"""
-        return run(
-            ["make", "-j", str(cpu_count()), "check"], cwd=settings["repo_base"].value
-        ).returncode
+        return self.make(settings, "check")
 
     def bench(self, settings):
         """runs automated benchmarks on source code or a subset there of"""
-        return run(
-            ["make", "-j", str(cpu_count()), "bench"], cwd=settings["repo_base"].value
-        ).returncode
+        return self.make(settings, "bench")
 
     def clean(self, settings):
         """cleans source code or a subset there of"""
+        if not self.make_dir(settings).exists():
+            print("m: nothing to clean,", self.make_dir(settings), "does not exist")
+            return 0
         return run(
-            ["make", "-j", str(cpu_count()), "clean"], cwd=settings["repo_base"].value
+            ["make", "-j", str(settings["jobs"].value), "clean"],
+            cwd=self.make_dir(settings),
         ).returncode
 
+    def format(self, settings):
+        """runs clang-format on the files that changed"""
+        return ClangFormat.format_changed(settings)
+
     def install(self, settings):
         """cleans source code or a subset there of"""
-        return run(
-            ["make", "-j", str(cpu_count()), "install"], cwd=settings["repo_base"].value
-        ).returncode
+        return self.make(settings, "install")
 
     def generate(self, settings):
         """generates a basic project"""
@@ -89,6 +239,7 @@ class AutotoolsPlugin(BasePlugin):
         """returns a dictionary of supported functions"""
         if "repo_base" in settings and (
             (settings["repo_base"].value / "autogen.sh").exists()
+            or (settings["repo_base"].value / "configure.ac").exists()
             or (settings["repo_base"].value / "configure").exists()
             or (settings["repo_base"].value / "GNUmakefile").exists()
             or (settings["repo_base"].value / "Makefile").exists()
@@ -97,6 +248,13 @@ class AutotoolsPlugin(BasePlugin):
             state = PluginSupport.DEFAULT_MAIN
         else:
             state = PluginSupport.NOT_ENABLED_BY_REPOSITORY
+        # a plain makefile is often only a convenience wrapper of another build system
+        if state == PluginSupport.DEFAULT_MAIN and AutotoolsPlugin.uses_autoconf(
+            settings
+        ):
+            format_state = PluginSupport.DEFAULT_MAIN
+        else:
+            format_state = PluginSupport.NOT_ENABLED_BY_REPOSITORY
 
         return {
             "configure": state,
@@ -105,5 +263,6 @@ class AutotoolsPlugin(BasePlugin):
             "bench": state,
             "clean": state,
             "install": state,
+            "format": format_state,
             "generate": PluginSupport.NOT_ENABLED_BY_DEFAULT,
         }
@@ -3,8 +3,10 @@ from pathlib import Path
 import itertools
 import enum
 import pprint
+import time
 import typing
 import logging
+from . import Process
 
 LOGGER = logging.getLogger(__name__)
 
@@ -141,6 +143,26 @@ class BasePlugin:
         """runs the provided target"""
         raise NotProvidedError("generate", self)
 
+    def analyze(self, settings):
+        """reports where the time of previous builds went"""
+        raise NotProvidedError("analyze", self)
+
+    def pgo(self, settings):
+        """builds with profile guided optimization and reports the speedup"""
+        raise NotProvidedError("pgo", self)
+
+    def profile(self, settings):
+        """runs a target under a sampling profiler"""
+        raise NotProvidedError("profile", self)
+
+    def stats(self, settings):
+        """reports the resources that previous actions used"""
+        raise NotProvidedError("stats", self)
+
+    def container(self, settings, method):
+        """runs method of the active plugins inside a container"""
+        raise NotProvidedError("container", self)
+
     def get_settings_factory(self, cls=None, priority=Setting.DEFAULT):
         """returns a helper function that fills in commmon arguments on the Setting object"""
         if cls is None:
@@ -272,25 +294,67 @@ class MBuildTool:
     def _run_action(self, method: str):
         """implmementation of the plugin calling logic"""
         LOGGER.info("running %s", method)
+        started = time.monotonic()
+        marker = Process.mark()
+        if method not in ("settings", "stats"):
+            containers = self._find_active_plugins("container")["main"]
+            if containers:
+                LOGGER.info("running %s in a container", method)
+                results = [containers[0].container(self._settings, method)]
+                self._record(method, time.monotonic() - started, marker, results)
+                return results
         plugins = self._find_active_plugins(method)
         results = []
-        try:
-            for before_plugin in plugins["before"]:
-                LOGGER.debug("%s: %s", method, get_class_name(before_plugin))
-                results.append(getattr(before_plugin, method)(self._settings))
-            for main_plugin in plugins["main"]:
-                LOGGER.debug("%s: %s", method, get_class_name(main_plugin))
-                results.append(getattr(main_plugin, method)(self._settings))
-            for after_plugin in plugins["after"]:
-                LOGGER.debug("%s: %s", method, get_class_name(after_plugin))
-                results.append(getattr(after_plugin, method)(self._settings))
-            self._actions_run += 1
-            if method == "settings":
-                self._update_settings(results)
-        except KeyboardInterrupt:
-            pass
+        for before_plugin in plugins["before"]:
+            LOGGER.debug("%s: %s", method, get_class_name(before_plugin))
+            results.append(getattr(before_plugin, method)(self._settings))
+        for main_plugin in plugins["main"]:
+            LOGGER.debug("%s: %s", method, get_class_name(main_plugin))
+            results.append(getattr(main_plugin, method)(self._settings))
+        for after_plugin in plugins["after"]:
+            LOGGER.debug("%s: %s", method, get_class_name(after_plugin))
+            results.append(getattr(after_plugin, method)(self._settings))
+        self._actions_run += 1
+        if method == "settings":
+            self._update_settings(results)
+            self._use_release_build_dir()
+        self._record(method, time.monotonic() - started, marker, results)
         return results
 
+    def _record(self, method, wall, marker, results):
+        """records the resources the children of an action used in the history"""
+        stats = self._settings.get("stats")
+        if method in ("settings", "stats") or stats is None or not stats.value:
+            return
+        returncode = next((r for r in results if isinstance(r, int) and r), 0)
+        try:
+            Process.record_action(
+                self._settings, method, wall, Process.usage_since(marker), returncode
+            )
+        except OSError as error:
+            LOGGER.debug("could not record the action: %s", error)
+
+    def _use_release_build_dir(self):
+        """keeps release objects from replacing the development build's by moving the
+        default build directory aside; done once all settings are merged since release
+        can come from the command line or the config file"""
+        release = self._settings.get("release")
+        build_dir = self._settings.get("build_dir")
+        if (
+            release is None
+            or not release.value
+            or build_dir is None
+            or build_dir.priority > Setting.LOW
+            or build_dir.value.name.endswith("_release")
+        ):
+            return
+        self._settings["build_dir"] = Setting(
+            "build_dir",
+            build_dir.value.with_name(f"{build_dir.value.name}_release"),
+            build_dir.source,
+            build_dir.priority,
+        )
+
     def _update_settings(self, new_settings):
         for new_setting in itertools.chain(*new_settings):
             current_setting = self._settings.get(new_setting.name, None)
@@ -374,3 +438,23 @@ class MBuildTool:
         """delgates to the right run function"""
         self._run_action("settings")
         self._error_codes.append(self._run_action("generate"))
+
+    def analyze(self):
+        """delegates to the right analyze function"""
+        self._run_action("settings")
+        self._error_codes.extend(self._run_action("analyze"))
+
+    def pgo(self):
+        """delegates to the right pgo function"""
+        self._run_action("settings")
+        self._error_codes.extend(self._run_action("pgo"))
+
+    def profile(self):
+        """delegates to the right profile function"""
+        self._run_action("settings")
+        self._error_codes.extend(self._run_action("profile"))
+
+    def stats(self):
+        """delegates to the right stats function"""
+        self._run_action("settings")
+        self._error_codes.extend(self._run_action("stats"))
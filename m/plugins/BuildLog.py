@@ -0,0 +1,446 @@
+"""parses build logs left behind by ninja and cargo and reports where build time went"""
+
+import json
+import logging
+import os
+import re
+from collections import defaultdict
+from pathlib import Path, PurePosixPath
+from .Process import run, PIPE, DEVNULL
+from jinja2 import Environment, PackageLoader
+from .Cache import state_dir, load_json, store_json
+
+LOGGER = logging.getLogger(__name__)
+
+MAX_BUILDS = 20
+TOP_N = 20
+TIMELINE_BUCKETS = 20
+
+GRAPH_NODE = re.compile(r'^"(0x[0-9a-f]+)" \[label="(.*)"(, shape=ellipse)?\]$')
+GRAPH_EDGE = re.compile(r'^"(0x[0-9a-f]+)" -> "(0x[0-9a-f]+)"')
+CARGO_UNIT_DATA = re.compile(r"const UNIT_DATA = (\[.*?\]);", re.DOTALL)
+
+
+def _empty_history():
+    return {
+        "offset": 0,
+        "inode": None,
+        "builds": [],
+        "totals": {},
+        "seen": [],
+        "critical_path": [],
+    }
+
+
+def _record_build(history, edges):
+    """appends a completed build to the history, attributing its time to each target"""
+    if not edges:
+        return
+    history["builds"].append(edges)
+    del history["builds"][:-MAX_BUILDS]
+    for edge in edges:
+        count, total = history["totals"].get(edge["name"], (0, 0))
+        history["totals"][edge["name"]] = (
+            count + 1,
+            total + edge["end"] - edge["start"],
+        )
+
+
+def _ninja_edges(entries):
+    """groups ninja log entries that were produced by the same command into one edge"""
+    edges = {}
+    for start, end, output, cmdhash in entries:
+        key = (start, end, cmdhash)
+        if key in edges:
+            edges[key]["outputs"].append(output)
+        else:
+            edges[key] = {
+                "name": output,
+                "start": start,
+                "end": end,
+                "outputs": [output],
+            }
+    return sorted(edges.values(), key=lambda e: (e["end"], e["start"]))
+
+
+def _split_builds(entries):
+    """ninja restarts its clock on every invocation and writes entries as they finish,
+    so a finish time that moves backwards marks the start of a new build"""
+    builds = [[]]
+    last_end = -1
+    for entry in entries:
+        if entry[1] < last_end and builds[-1]:
+            builds.append([])
+        builds[-1].append(entry)
+        last_end = entry[1]
+    return [_ninja_edges(build) for build in builds if build]
+
+
+def update_ninja_history(settings):
+    """incrementally reads new entries of .ninja_log into the persisted history"""
+    log_path = settings["build_dir"].value / ".ninja_log"
+    history_path = state_dir(settings) / "ninja_history.json"
+    history = load_json(history_path, _empty_history())
+    if not log_path.exists():
+        return history
+
+    stat = log_path.stat()
+    recompacted = stat.st_ino != history["inode"] or stat.st_size < history["offset"]
+    with open(log_path) as log:
+        if not recompacted:
+            log.seek(history["offset"])
+        entries = []
+        for line in log:
+            if line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 5:
+                continue
+            entries.append((int(fields[0]), int(fields[1]), fields[3], fields[4]))
+        history["offset"] = log.tell()
+    history["inode"] = stat.st_ino
+
+    builds = _split_builds(entries)
+    if recompacted and history["builds"]:
+        # ninja rewrote the log; everything but the latest build was already seen
+        builds = builds[-1:]
+    for build in builds:
+        _record_build(history, build)
+    store_json(history_path, history)
+    return history
+
+
+def _ninja_dependencies(build_dir):
+    """returns a map from each ninja output to the outputs it directly depends on"""
+    result = run(
+        ["ninja", "-C", str(build_dir), "-t", "graph"],
+        stdout=PIPE,
+        stderr=DEVNULL,
+        universal_newlines=True,
+    )
+    if result.returncode != 0:
+        return None
+    labels = {}
+    rule_nodes = set()
+    inputs = defaultdict(set)
+    for line in result.stdout.splitlines():
+        line = line.strip()
+        node = GRAPH_NODE.match(line)
+        if node:
+            labels[node.group(1)] = node.group(2)
+            if node.group(3):
+                rule_nodes.add(node.group(1))
+            continue
+        edge = GRAPH_EDGE.match(line)
+        if edge:
+            inputs[edge.group(2)].add(edge.group(1))
+
+    deps = defaultdict(set)
+    for node, node_inputs in inputs.items():
+        if node in rule_nodes:
+            continue
+        for node_input in node_inputs:
+            if node_input in rule_nodes:
+                deps[labels[node]].update(labels[i] for i in inputs[node_input])
+            else:
+                deps[labels[node]].add(labels[node_input])
+    return deps
+
+
+def _graph_critical_path(edges, deps):
+    """longest chain of dependent edges weighted by how long they took in this build"""
+    by_output = {}
+    for edge in edges:
+        for output in edge["outputs"]:
+            by_output[output] = edge
+
+    best = {}
+    for root in by_output:
+        stack = [(root, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if node in best:
+                continue
+            children = deps.get(node, ())
+            if not expanded:
+                stack.append((node, True))
+                stack.extend((c, False) for c in children if c not in best)
+                continue
+            chain = max(
+                (best[c] for c in children if c in best),
+                default=(0, ()),
+                key=lambda c: c[0],
+            )
+            edge = by_output.get(node)
+            if edge is not None and edge["name"] not in chain[1]:
+                chain = (
+                    chain[0] + edge["end"] - edge["start"],
+                    chain[1] + (edge["name"],),
+                )
+            best[node] = chain
+
+    _, names = max(best.values(), default=(0, ()), key=lambda c: c[0])
+    return list(names)
+
+
+def _timeline_critical_path(edges):
+    """approximates the critical path by walking back from the last edge to finish,
+    each time picking the edge that finished last before the current one started"""
+    if not edges:
+        return []
+    path = []
+    current = max(edges, key=lambda e: e["end"])
+    while current is not None:
+        path.append(current["name"])
+        candidates = [e for e in edges if e["end"] <= current["start"]]
+        current = max(candidates, key=lambda e: e["end"]) if candidates else None
+    return list(reversed(path))
+
+
+def _union_length(intervals):
+    total = 0
+    current_start = current_end = None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+def summarize(edges, critical_path, totals):
+    """computes the report for a single build
+
+    ninja and cargo only record when each step started and finished, so cpu time is
+    estimated as the sum of step durations while wall time is the time covered by them
+    """
+    if not edges:
+        return None
+    begin = min(e["start"] for e in edges)
+    finish = max(e["end"] for e in edges)
+    wall = finish - begin
+    cpu = sum(e["end"] - e["start"] for e in edges)
+
+    timeline = []
+    width = max(wall / TIMELINE_BUCKETS, 1)
+    for bucket in range(TIMELINE_BUCKETS):
+        low = begin + bucket * width
+        high = low + width
+        busy = sum(max(0, min(e["end"], high) - max(e["start"], low)) for e in edges)
+        timeline.append(
+            {"start_ms": round(low - begin), "parallelism": round(busy / width, 2)}
+        )
+
+    directories = defaultdict(list)
+    for edge in edges:
+        directories[str(PurePosixPath(edge["name"]).parent)].append(
+            (edge["start"], edge["end"])
+        )
+
+    by_name = {e["name"]: e for e in edges}
+    targets = sorted(edges, key=lambda e: e["end"] - e["start"], reverse=True)
+    return {
+        "wall_ms": wall,
+        "cpu_ms": cpu,
+        "parallelism": round(cpu / wall, 2) if wall else 0,
+        "steps": len(edges),
+        "timeline": timeline,
+        "critical_path": [
+            {"name": name, "ms": by_name[name]["end"] - by_name[name]["start"]}
+            for name in critical_path
+        ],
+        "targets": [
+            {
+                "name": e["name"],
+                "wall_ms": e["end"] - e["start"],
+                "builds": totals.get(e["name"], (0, 0))[0],
+                "total_ms": totals.get(e["name"], (0, 0))[1],
+            }
+            for e in targets[:TOP_N]
+        ],
+        "directories": sorted(
+            (
+                {
+                    "name": name,
+                    "wall_ms": _union_length(intervals),
+                    "cpu_ms": sum(end - start for start, end in intervals),
+                }
+                for name, intervals in directories.items()
+            ),
+            key=lambda d: d["cpu_ms"],
+            reverse=True,
+        )[:TOP_N],
+        "history": sorted(
+            (
+                {"name": name, "builds": count, "total_ms": total}
+                for name, (count, total) in totals.items()
+            ),
+            key=lambda t: t["total_ms"],
+            reverse=True,
+        )[:TOP_N],
+    }
+
+
+def _seconds(ms):
+    return f"{ms / 1000:8.2f}s"
+
+
+def print_summary(report):
+    """prints the human readable summary of a report"""
+    print(
+        f"wall {_seconds(report['wall_ms']).strip()}, cpu {_seconds(report['cpu_ms']).strip()},"
+        f" {report['steps']} steps, average parallelism {report['parallelism']}"
+    )
+    print("\ncritical path:")
+    for step in report["critical_path"]:
+        print(_seconds(step["ms"]), step["name"])
+    print("\nslowest targets:")
+    for target in report["targets"]:
+        print(_seconds(target["wall_ms"]), target["name"])
+    print("\nslowest directories (wall/cpu):")
+    for directory in report["directories"]:
+        print(
+            _seconds(directory["wall_ms"]),
+            _seconds(directory["cpu_ms"]),
+            directory["name"],
+        )
+    print("\nmost time across recorded builds:")
+    for target in report["history"]:
+        print(_seconds(target["total_ms"]), f"{target['builds']:4d}x", target["name"])
+    print("\nparallelism over time:")
+    peak = max((t["parallelism"] for t in report["timeline"]), default=1) or 1
+    for bucket in report["timeline"]:
+        bar = "#" * round(40 * bucket["parallelism"] / peak)
+        print(_seconds(bucket["start_ms"]), f"{bucket['parallelism']:6.2f}", bar)
+
+
+def write_report(settings, report, kind):
+    """writes the machine readable report to the build directory and returns its path"""
+    if kind == "html":
+        template_env = Environment(
+            loader=PackageLoader("m", "templates"), autoescape=True
+        )
+        render = template_env.get_template("analyze/report.html.j2").render(
+            report=report
+        )
+    else:
+        kind = "json"
+        render = json.dumps(report, indent=2)
+    dest = settings["build_dir"].value / f"m_analyze.{kind}"
+    with open(dest, "w") as outfile:
+        outfile.write(render)
+    return dest
+
+
+def report(settings, report_data):
+    """prints the summary and writes the report requested by cmdline_analyze"""
+    if report_data is None:
+        print("no build steps were recorded; run a build first")
+        return 1
+    args = settings["cmdline_analyze"].value
+    kind = args[0] if args else "json"
+    print_summary(report_data)
+    if kind != "text":
+        print("\nreport written to", write_report(settings, report_data, kind))
+    return 0
+
+
+def analyze_ninja(settings):
+    """analyzes the most recent ninja build recorded in build_dir"""
+    if not (settings["build_dir"].value / ".ninja_log").exists():
+        print("no .ninja_log in", settings["build_dir"].value)
+        return 1
+    history = update_ninja_history(settings)
+    if not history["builds"]:
+        return report(settings, None)
+    edges = history["builds"][-1]
+    deps = _ninja_dependencies(settings["build_dir"].value)
+    if deps is not None:
+        critical_path = _graph_critical_path(edges, deps)
+    else:
+        critical_path = _timeline_critical_path(edges)
+    return report(settings, summarize(edges, critical_path, history["totals"]))
+
+
+def cargo_target_dir(settings):
+    """returns the directory cargo writes its build artifacts to"""
+    return Path(
+        os.environ.get("CARGO_TARGET_DIR", settings["repo_base"].value / "target")
+    )
+
+
+def _cargo_edges(timing_html):
+    """reads the unit timings that cargo --timings embeds in its html report"""
+    with open(timing_html) as infile:
+        match = CARGO_UNIT_DATA.search(infile.read())
+    if match is None:
+        return [], {}
+    units = json.loads(match.group(1))
+    edges = []
+    unlocked_by = {}
+    names = {}
+    for unit in units:
+        name = f"{unit['name']} {unit['version']}{unit.get('target', '')}".strip()
+        names[unit["i"]] = name
+        start = round(unit["start"] * 1000)
+        edges.append(
+            {
+                "name": name,
+                "start": start,
+                "end": start + round(unit["duration"] * 1000),
+                "outputs": [name],
+            }
+        )
+    for unit in units:
+        for unlocked in unit.get("unlocked_units", []):
+            unlocked_by[names[unlocked]] = names[unit["i"]]
+    return edges, unlocked_by
+
+
+def _cargo_critical_path(edges, unlocked_by):
+    """a unit is unlocked by the last of its dependencies to finish, so following
+    unlocked_by back from the last unit to finish walks the critical path"""
+    if not edges:
+        return []
+    path = [max(edges, key=lambda e: e["end"])["name"]]
+    while path[-1] in unlocked_by and unlocked_by[path[-1]] not in path:
+        path.append(unlocked_by[path[-1]])
+    return list(reversed(path))
+
+
+def analyze_cargo(settings, env=None):
+    """analyzes the most recent cargo build that was run with --timings"""
+    history_path = state_dir(settings) / "cargo_history.json"
+    history = load_json(history_path, _empty_history())
+    timings_dir = cargo_target_dir(settings) / "cargo-timings"
+
+    def unseen():
+        return sorted(
+            (
+                p
+                for p in timings_dir.glob("cargo-timing-*.html")
+                if p.name not in history["seen"]
+            ),
+            key=lambda p: p.stat().st_mtime,
+        )
+
+    if not history["builds"] and not unseen():
+        run(["cargo", "build", "--timings"], cwd=settings["repo_base"].value, env=env)
+
+    for timing in unseen():
+        edges, unlocked_by = _cargo_edges(timing)
+        _record_build(history, edges)
+        history["seen"].append(timing.name)
+        history["critical_path"] = _cargo_critical_path(edges, unlocked_by)
+    store_json(history_path, history)
+
+    if not history["builds"]:
+        return report(settings, None)
+    return report(
+        settings,
+        summarize(history["builds"][-1], history["critical_path"], history["totals"]),
+    )
@@ -1,26 +1,143 @@
-from subprocess import run, DEVNULL, PIPE
-from .Base import plugin, BasePlugin, PluginSupport
+from .Process import run, DEVNULL, PIPE
+import logging
+import shutil
+import typing
+from .Base import plugin, BasePlugin, PluginSupport, Setting
+from .Settings import Settings
+from . import BuildLog
+from . import ClangFormat
+from . import ClangTidy
+from . import CompilerCache
+from . import FlameGraph
+from . import Pgo
+from . import Progress
+from . import TimeTrace
+from . import Unity
+from .Cache import state_dir
 import json
+import os
 from jinja2 import Environment, PackageLoader, select_autoescape
 
+LOGGER = logging.getLogger(__name__)
+
+# ThinLTO backend threads each concurrent link gets
+LINK_THREADS = 8
+
 
 @plugin
 class CMakePlugin(BasePlugin):
+    def settings(self, current_settings) -> typing.List[Setting]:
+        """returns settings that this plugin is authoritative for"""
+        make_setting = self.get_settings_factory(priority=Setting.LOW)
+        return [
+            make_setting("cmake_unity", False),
+            make_setting("cmake_pch", []),
+            make_setting("cmake_unity_edit_weight", 10),
+            make_setting("compiler_cache_stats", True),
+            make_setting(
+                "thinlto_cache_policy",
+                "prune_interval=20m:prune_after=168h:cache_size=10%:cache_size_bytes=8g",
+            ),
+        ]
+
+    @staticmethod
+    def cmake_cache(build_dir):
+        """returns the entries of CMakeCache.txt without their types"""
+        entries = {}
+        try:
+            with open(build_dir / "CMakeCache.txt") as cache:
+                for line in cache:
+                    if line.startswith(("#", "//")) or "=" not in line:
+                        continue
+                    key, value = line.rstrip("\n").split("=", 1)
+                    entries[key.split(":", 1)[0]] = value
+        except OSError:
+            pass
+        return entries
+
+    @staticmethod
+    def unity_args(settings):
+        """returns the cmake arguments of the unity build and precompiled header mode"""
+        if not settings["cmake_unity"].value and not settings["cmake_pch"].value:
+            return []
+        args = [f"-DCMAKE_PROJECT_INCLUDE={Unity.write_project_include(settings)}"]
+        if settings["cmake_unity"].value:
+            args.append("-DCMAKE_UNITY_BUILD=ON")
+        return args
+
+    def release_args(self, settings, flags):
+        """returns the cmake arguments of an optimized build, adding the compile flags
+        to flags
+
+        with clang and lld the build uses ThinLTO with an on-disk cache, so relinking
+        after an edit only redoes the code generation of the modules that changed.
+        ninja links in a pool sized so that the ThinLTO backends of concurrent links
+        together use about one thread per core.
+        """
+        args = ["-DCMAKE_BUILD_TYPE=Release"]
+        configured = [
+            os.environ[name] for name in ("CC", "CXX") if os.environ.get(name)
+        ]
+        if any("clang" not in compiler for compiler in configured):
+            LOGGER.warning(
+                "ThinLTO needs clang, building %s without LTO", " and ".join(configured)
+            )
+            return args
+        cc, cxx = self._clang()
+        if not self.has_lld() or not shutil.which(cxx):
+            LOGGER.info("ThinLTO needs clang and lld, building without LTO")
+            return args
+        jobs = settings["jobs"].value
+        links = max(1, jobs // LINK_THREADS)
+        cache = state_dir(settings, "thinlto")
+        link_flags = " ".join(
+            [
+                f"-Wl,--thinlto-cache-dir={cache}",
+                f"-Wl,--thinlto-cache-policy={settings['thinlto_cache_policy'].value}",
+                f"-Wl,--thinlto-jobs={max(1, jobs // links)}",
+            ]
+        )
+        flags.append("-flto=thin")
+        args.extend([f"-DCMAKE_C_COMPILER={cc}", f"-DCMAKE_CXX_COMPILER={cxx}"])
+        for kind in ("EXE", "SHARED", "MODULE"):
+            args.append(f"-DCMAKE_{kind}_LINKER_FLAGS={link_flags}")
+        if self.has_ninja():
+            args.extend(
+                [f"-DCMAKE_JOB_POOLS=m_link={links}", "-DCMAKE_JOB_POOL_LINK=m_link"]
+            )
+        return args
+
+    def sync_unity(self, settings):
+        """reconfigures an existing build directory if the unity build or precompiled
+        header mode was turned on or off since it was configured"""
+        build_dir = settings["build_dir"].value
+        cache = self.cmake_cache(build_dir)
+        args = self.unity_args(settings)
+        include = str(state_dir(settings) / "unity.cmake")
+        has_include = cache.get("CMAKE_PROJECT_INCLUDE") == include
+        has_unity = cache.get("CMAKE_UNITY_BUILD", "OFF").upper() in ("ON", "TRUE", "1")
+        if args:
+            if has_include and has_unity == settings["cmake_unity"].value:
+                return 0
+        elif has_include:
+            args = ["-UCMAKE_PROJECT_INCLUDE", "-DCMAKE_UNITY_BUILD=OFF"]
+        else:
+            return 0
+        return run(["cmake", *args, "."], cwd=build_dir).returncode
+
     def configure(self, settings):
         """configure the build directory"""
-        if not self.is_configured(settings):
+        if self.is_configured(settings):
+            return self.sync_unity(settings)
+        else:
             settings["build_dir"].value.mkdir(exist_ok=True)
-            args = ["cmake", ".."]
+            args = ["cmake", "..", "-DCMAKE_EXPORT_COMPILE_COMMANDS=ON"]
+            flags = []
             if self.has_ninja():
                 args.extend(["-G", "Ninja"])
             if self.has_lld():
-                args.extend(
-                    [
-                        "-DCMAKE_LINKER=lld",
-                        "-DCMAKE_C_FLAGS=-fuse-ld=lld",
-                        "-DCMAKE_CXX_FLAGS=-fuse-ld=lld",
-                    ]
-                )
+                args.append("-DCMAKE_LINKER=lld")
+                flags.append("-fuse-ld=lld")
 
             if self.has_sccache():
                 args.extend(
@@ -38,6 +155,16 @@ class CMakePlugin(BasePlugin):
                         "-DCMAKE_CUDA_COMPILER_LAUNCHER=ccache",
                     ]
                 )
+            if settings["release"].value:
+                args.extend(self.release_args(settings, flags))
+            if flags:
+                args.extend(
+                    [
+                        f"-DCMAKE_C_FLAGS={' '.join(flags)}",
+                        f"-DCMAKE_CXX_FLAGS={' '.join(flags)}",
+                    ]
+                )
+            args.extend(self.unity_args(settings))
             args.extend(settings["cmdline_configure"].value)
             return run(args, cwd=settings["build_dir"].value).returncode
 
@@ -76,16 +203,34 @@ class CMakePlugin(BasePlugin):
     def print_builddir(settings):
         print(f"m: Entering directory '{settings['build_dir'].value!s}'", flush=True)
 
+    def compiler_cache(self, settings):
+        """returns the compiler cache whose statistics are reported after builds"""
+        if not settings["compiler_cache_stats"].value:
+            return None
+        return CompilerCache.launcher(self.cmake_cache(settings["build_dir"].value))
+
     def build(self, settings):
         """compiles the source code or a subset thereof"""
         self.configure(settings)
 
         if self.is_configured(settings):
             self.print_builddir(settings)
-            return run(
+            kind = (
+                "ninja"
+                if (settings["build_dir"].value / "build.ninja").exists()
+                else "make"
+            )
+            tool = self.compiler_cache(settings)
+            before = CompilerCache.stats(tool) if tool else None
+            returncode = Progress.run_with_eta(
                 ["cmake", "--build", ".", *settings["cmdline_build"].value],
+                settings,
+                kind,
                 cwd=settings["build_dir"].value,
-            ).returncode
+            )
+            if tool:
+                CompilerCache.record(settings, tool, before)
+            return returncode
         else:
             print("failed to configure")
             return -1
@@ -120,6 +265,29 @@ class CMakePlugin(BasePlugin):
             print("failed to configure")
             return -1
 
+    def tidy(self, settings):
+        """runs clang-tidy on every translation unit that changed"""
+        if not ClangTidy.available():
+            print("m: clang-tidy is not installed")
+            return 1
+        self.configure(settings)
+
+        if self.is_configured(settings):
+            self.print_builddir(settings)
+            if not (settings["build_dir"].value / "compile_commands.json").exists():
+                run(
+                    ["cmake", "-DCMAKE_EXPORT_COMPILE_COMMANDS=ON", "."],
+                    cwd=settings["build_dir"].value,
+                )
+            return ClangTidy.tidy(settings)
+        else:
+            print("failed to configure")
+            return -1
+
+    def format(self, settings):
+        """runs clang-format on the files that changed"""
+        return ClangFormat.format_changed(settings)
+
     def install(self, settings):
         """compiles the source code or a subset thereof"""
         self.configure(settings)
@@ -133,6 +301,131 @@ class CMakePlugin(BasePlugin):
             print("failed to configure")
             return -1
 
+    def analyze(self, settings):
+        """reports where the time of the last build went"""
+        args = settings["cmdline_analyze"].value
+        if args and args[0] == "cache":
+            tool = CompilerCache.launcher(self.cmake_cache(settings["build_dir"].value))
+            if tool is None:
+                print("m: the build directory does not use sccache or ccache")
+                return 1
+            return CompilerCache.diagnose(settings, tool)
+        if args and args[0].startswith("t"):
+            return self._analyze_time_trace(settings)
+        return BuildLog.analyze_ninja(settings)
+
+    @staticmethod
+    def _clang():
+        """returns the C and C++ compilers for builds that need clang"""
+        cc = os.environ.get("CC", "")
+        cxx = os.environ.get("CXX", "")
+        return (
+            cc if "clang" in cc else "clang",
+            cxx if "clang" in cxx else "clang++",
+        )
+
+    def _configure_side(self, settings, side_dir, flags, initial_args=(), clang=True):
+        """configures a side build directory with flags, and with clang unless clang
+        is False, re-running cmake only when the flags changed since it was last
+        configured"""
+        cache = self.cmake_cache(side_dir)
+        if cache.get("CMAKE_CXX_FLAGS") == flags:
+            return 0
+        cc, cxx = self._clang()
+        configure = [
+            "cmake",
+            "-S",
+            str(settings["repo_base"].value),
+            "-B",
+            str(side_dir),
+            f"-DCMAKE_C_FLAGS={flags}",
+            f"-DCMAKE_CXX_FLAGS={flags}",
+        ]
+        if not cache:
+            if self.has_ninja():
+                configure.extend(["-G", "Ninja"])
+            if clang:
+                configure.extend(
+                    [f"-DCMAKE_C_COMPILER={cc}", f"-DCMAKE_CXX_COMPILER={cxx}"]
+                )
+            configure.extend(initial_args)
+        configure.extend(settings["cmdline_configure"].value)
+        return run(configure).returncode
+
+    def _build_side(self, settings, side_dir):
+        return run(
+            ["cmake", "--build", str(side_dir), "-j", str(settings["jobs"].value)]
+        ).returncode
+
+    def _analyze_time_trace(self, settings):
+        """builds a side build directory with -ftime-trace and aggregates the traces"""
+        side_dir = Settings.side_build_dir(settings, "timetrace")
+        returncode = self._configure_side(settings, side_dir, "-ftime-trace")
+        if returncode:
+            return returncode
+        returncode = self._build_side(settings, side_dir)
+        if returncode:
+            return returncode
+        return TimeTrace.analyze(settings, side_dir)
+
+    def pgo(self, settings):
+        """builds an instrumented variant, trains it with pgo_train or the tests and
+        compares a build optimized with the merged profile against a release build"""
+        flags = {
+            "gen": "-fprofile-generate={}",
+            "base": "",
+            "use": "-fprofile-use={} -Wno-profile-instr-unprofiled"
+            " -Wno-profile-instr-out-of-date",
+        }
+        command = Pgo.train_command(settings) or ["ctest", "--output-on-failure"]
+
+        def build(stage, path):
+            side_dir = Settings.side_build_dir(settings, f"pgo_{stage}")
+            returncode = self._configure_side(
+                settings,
+                side_dir,
+                flags[stage].format(path),
+                ["-DCMAKE_BUILD_TYPE=Release"],
+            )
+            if returncode:
+                return returncode
+            return self._build_side(settings, side_dir)
+
+        def train(stage):
+            side_dir = Settings.side_build_dir(settings, f"pgo_{stage}")
+            return run(command, cwd=side_dir).returncode
+
+        version = run(
+            [self._clang()[1], "--version"], stdout=PIPE, universal_newlines=True
+        ).stdout
+        key = Pgo.profile_key(
+            settings, version, *command, *settings["cmdline_configure"].value
+        )
+        return Pgo.pgo(settings, settings["llvm_profdata"].value, key, build, train)
+
+    def profile(self, settings):
+        """builds a side build directory with frame pointers and debug info and runs
+        the target or command given with -c, or pgo_train, under perf"""
+        command = settings["cmdline_profile"].value or Pgo.train_command(settings)
+        if not command:
+            print("m: pass the target or command to profile, e.g. m profile -c app")
+            return 1
+        side_dir = Settings.side_build_dir(settings, "profile")
+        returncode = self._configure_side(
+            settings,
+            side_dir,
+            FlameGraph.FRAME_POINTER_FLAGS,
+            ["-DCMAKE_BUILD_TYPE=RelWithDebInfo"],
+            clang=False,
+        )
+        if returncode:
+            return returncode
+        returncode = self._build_side(settings, side_dir)
+        if returncode:
+            return returncode
+        command = FlameGraph.resolve_target(side_dir, command)
+        return FlameGraph.profile(settings, command, side_dir)
+
     def generate(self, settings):
         g_settings = settings["cmdline_generate"].value
         if (not g_settings) or g_settings[0].startswith("l"):
@@ -244,11 +537,22 @@ class CMakePlugin(BasePlugin):
         else:
             state = PluginSupport.NOT_ENABLED_BY_REPOSITORY
 
+        if (Settings.find_repo_base() / "CMakeLists.txt").exists():
+            settings_state = PluginSupport.DEFAULT_AFTER_MAIN
+        else:
+            settings_state = PluginSupport.NOT_ENABLED_BY_REPOSITORY
+
         return {
+            "settings": settings_state,
             "configure": state,
             "build": state,
             "test": state,
             "clean": state,
             "install": state,
+            "format": state,
+            "tidy": state,
+            "analyze": state,
+            "pgo": state,
+            "profile": state,
             "generate": PluginSupport.NOT_ENABLED_BY_DEFAULT,
         }
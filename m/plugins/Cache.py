@@ -0,0 +1,73 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from .Paths import state_dir, user_cache_dir  # noqa: F401 re-exported
+from .Process import run, PIPE, DEVNULL
+
+LOGGER = logging.getLogger(__name__)
+
+
+def load_json(path, default=None):
+    """loads json state, returning default if it is missing or corrupt"""
+    try:
+        with open(path) as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return default
+
+
+def store_json(path, data):
+    """atomically replaces path with the json encoding of data"""
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w") as outfile:
+        json.dump(data, outfile)
+    os.replace(tmp, path)
+
+
+def digest_files(paths, extra=()) -> str:
+    """returns a stable hash over the names and contents of paths plus extra strings"""
+    hasher = hashlib.sha256()
+    for item in extra:
+        hasher.update(str(item).encode())
+        hasher.update(b"\0")
+    for path in sorted(Path(p) for p in paths):
+        hasher.update(str(path).encode())
+        hasher.update(b"\0")
+        try:
+            with open(path, "rb") as infile:
+                for chunk in iter(lambda: infile.read(1 << 20), b""):
+                    hasher.update(chunk)
+        except OSError:
+            hasher.update(b"<missing>")
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+def source_files(repo_base, *pathspecs):
+    """returns the tracked and untracked but not ignored files matching pathspecs"""
+    result = run(
+        ["git", "ls-files", "--cached", "--others", "--exclude-standard", *pathspecs],
+        cwd=repo_base,
+        stdout=PIPE,
+        stderr=DEVNULL,
+        universal_newlines=True,
+    )
+    if result.returncode != 0:
+        return [
+            path
+            for pathspec in pathspecs
+            for path in Path(repo_base).rglob("*" if pathspec == "." else pathspec)
+            if path.is_file() and ".git" not in path.parts
+        ]
+    return [Path(repo_base, line) for line in result.stdout.splitlines() if line]
+
+
+def source_digest(repo_base, *pathspecs, extra=()):
+    """returns a hash of the current contents of the source files matching pathspecs"""
+    return digest_files(
+        (path for path in source_files(repo_base, *pathspecs) if path.exists()),
+        extra=extra,
+    )
@@ -0,0 +1,261 @@
+"""runs the tests of a cargo workspace one process per test across a pool, ordered by
+the history of previous runs"""
+
+import json
+import logging
+import os
+import time
+import zlib
+from functools import partial
+from pathlib import Path
+from .Process import run, run_all, run_async, PIPE, STDOUT, DEVNULL, TimeoutExpired
+from .Cache import state_dir, load_json, store_json
+
+LOGGER = logging.getLogger(__name__)
+
+# options of cargo test that take the next argument as their value
+CARGO_VALUE_OPTIONS = {
+    "-p",
+    "--package",
+    "--exclude",
+    "--test",
+    "--bin",
+    "--example",
+    "--bench",
+    "-F",
+    "--features",
+    "-j",
+    "--jobs",
+    "--profile",
+    "--target",
+    "--target-dir",
+    "--manifest-path",
+    "--message-format",
+    "--color",
+    "--config",
+    "-Z",
+}
+
+
+def parse_shard(args):
+    """removes --shard i/n from args and returns the remaining args and the 1-based
+    shard index and count"""
+    remaining = []
+    shard = (1, 1)
+    args = iter(args)
+    for arg in args:
+        if arg == "--shard" or arg.startswith("--shard="):
+            value = arg.split("=", 1)[1] if "=" in arg else next(args, "1/1")
+            try:
+                index, count = value.split("/")
+                shard = (int(index), int(count))
+            except ValueError:
+                raise ValueError(f"invalid shard {value}, expected i/n") from None
+            if not 1 <= shard[0] <= shard[1]:
+                raise ValueError(f"invalid shard {value}, expected 1 <= i <= n")
+        else:
+            remaining.append(arg)
+    return remaining, shard
+
+
+def split_filters(args):
+    """separates the test name filters from the options for cargo"""
+    options = []
+    filters = []
+    args = iter(args)
+    for arg in args:
+        if not arg.startswith("-"):
+            filters.append(arg)
+            continue
+        options.append(arg)
+        if arg in CARGO_VALUE_OPTIONS:
+            options.append(next(args, ""))
+    return options, filters
+
+
+def in_shard(name, shard):
+    """returns if a test belongs to a shard; the hash only depends on the test's name so
+    a test stays on the same machine as the workspace changes"""
+    index, count = shard
+    return zlib.crc32(name.encode()) % count == index - 1
+
+
+def test_binaries(settings, args, env):
+    """builds the test binaries once and returns a list of the binaries and if any
+    library targets were built"""
+    result = run(
+        [
+            "cargo",
+            "test",
+            "--no-run",
+            "--message-format=json-render-diagnostics",
+            *args,
+        ],
+        cwd=settings["repo_base"].value,
+        env=env,
+        stdout=PIPE,
+        universal_newlines=True,
+    )
+    if result.returncode != 0:
+        return None, False
+    binaries = []
+    has_lib = False
+    for line in result.stdout.splitlines():
+        try:
+            message = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if message.get("reason") != "compiler-artifact":
+            continue
+        if not message["profile"]["test"] or not message.get("executable"):
+            continue
+        target = message["target"]
+        has_lib |= any(kind.endswith("lib") for kind in target["kind"])
+        package = Path(message["manifest_path"]).parent
+        binaries.append(
+            {
+                "name": f"{package.name}/{target['name']}-{target['kind'][0]}",
+                "executable": message["executable"],
+                "package": str(package),
+            }
+        )
+    return binaries, has_lib
+
+
+async def _list(binary, *extra):
+    result = await run_async(
+        [binary["executable"], "--list", "--format", "terse", *extra],
+        cwd=binary["package"],
+        stdin=DEVNULL,
+        stdout=PIPE,
+        stderr=DEVNULL,
+        universal_newlines=True,
+    )
+    return [
+        line[: -len(": test")]
+        for line in result.stdout.splitlines()
+        if line.endswith(": test")
+    ]
+
+
+async def list_tests(binary, filters=()):
+    """returns the tests in a test binary that are not ignored and whose names contain
+    one of filters, if any"""
+    ignored = set(await _list(binary, "--ignored", *filters))
+    return [test for test in await _list(binary, *filters) if test not in ignored]
+
+
+async def _run_test(binary, test, env, timeout):
+    """runs a single test and returns its status, duration and output"""
+    env = dict(env)
+    env["CARGO_MANIFEST_DIR"] = binary["package"]
+    env["CARGO_PKG_NAME"] = Path(binary["package"]).name
+    library_path = str(Path(binary["executable"]).parent)
+    env["LD_LIBRARY_PATH"] = os.pathsep.join(
+        filter(None, [library_path, env.get("LD_LIBRARY_PATH")])
+    )
+    started = time.monotonic()
+    try:
+        result = await run_async(
+            [binary["executable"], "--exact", test, "--test-threads=1"],
+            cwd=binary["package"],
+            env=env,
+            stdin=DEVNULL,
+            stdout=PIPE,
+            stderr=STDOUT,
+            universal_newlines=True,
+            timeout=timeout,
+        )
+    except TimeoutExpired as error:
+        output = error.output or ""
+        if isinstance(output, bytes):
+            output = output.decode(errors="replace")
+        return "timeout", time.monotonic() - started, output
+    status = "pass" if result.returncode == 0 else "fail"
+    return status, time.monotonic() - started, result.stdout
+
+
+def run_tests(settings, env):
+    """builds the workspace's tests once and runs each test in its own process on up to
+    jobs workers, slowest and previously failing tests first"""
+    repo_base = settings["repo_base"].value
+    try:
+        args, shard = parse_shard(settings["cmdline_test"].value)
+    except ValueError as error:
+        print(f"m: {error}")
+        return 1
+    if "--" in args or "--doc" in args:
+        return run(["cargo", "test", *args], cwd=repo_base, env=env).returncode
+
+    options, filters = split_filters(args)
+    binaries, has_lib = test_binaries(settings, options, env)
+    if binaries is None:
+        return 1
+
+    history_path = state_dir(settings) / "cargo_test.json"
+    history = load_json(history_path, {"durations": {}, "failed": []})
+    listed = run_all(
+        [partial(list_tests, binary, filters) for binary in binaries],
+        settings["jobs"].value,
+    )
+    tests = [
+        (binary, test)
+        for binary, names in zip(binaries, listed)
+        for test in names
+        if in_shard(f"{binary['name']}::{test}", shard)
+    ]
+
+    durations = history["durations"]
+    failed = set(history["failed"])
+    slowest = max(durations.values(), default=1.0)
+    tests.sort(
+        key=lambda item: (
+            f"{item[0]['name']}::{item[1]}" not in failed,
+            -durations.get(f"{item[0]['name']}::{item[1]}", slowest),
+        )
+    )
+
+    timeout = settings["test_timeout"].value or None
+    LOGGER.info(
+        "running %d tests from %d binaries, shard %d/%d",
+        len(tests),
+        len(binaries),
+        *shard,
+    )
+    counts = {"pass": 0, "fail": 0, "timeout": 0}
+    failed = set()
+
+    async def run_and_report(binary, test):
+        name = f"{binary['name']}::{test}"
+        status, duration, output = await _run_test(binary, test, env, timeout)
+        counts[status] += 1
+        durations[name] = round(duration, 3)
+        if status != "pass":
+            failed.add(name)
+            print(f"{status.upper()} [{duration:.2f}s] {name}")
+            print(output, end="", flush=True)
+
+    run_all(
+        [partial(run_and_report, binary, test) for binary, test in tests],
+        settings["jobs"].value,
+    )
+
+    returncode = 1 if counts["fail"] or counts["timeout"] else 0
+    if has_lib and shard[0] == 1:
+        doc = run(["cargo", "test", "--doc", *args], cwd=repo_base, env=env)
+        returncode = returncode or doc.returncode
+
+    names = {f"{binary['name']}::{test}" for binary, test in tests}
+    # a filtered run did not list every test, so it cannot tell which ones were removed
+    history["durations"] = {
+        name: duration
+        for name, duration in durations.items()
+        if name in names or filters or not in_shard(name, shard)
+    }
+    history["failed"] = sorted((set(history["failed"]) - names) | failed)
+    store_json(history_path, history)
+    print(
+        f"m: {counts['pass']} passed, {counts['fail']} failed,"
+        f" {counts['timeout']} timed out in {len(binaries)} test binaries"
+    )
+    return returncode
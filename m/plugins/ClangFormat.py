@@ -0,0 +1,123 @@
+"""runs clang-format on the C and C++ files that changed according to git"""
+
+import hashlib
+import logging
+import shutil
+from functools import partial
+from .Process import run, run_all, run_async, PIPE, DEVNULL
+from .Cache import state_dir, load_json, store_json, digest_files
+
+LOGGER = logging.getLogger(__name__)
+
+SUFFIXES = {
+    ".c",
+    ".cc",
+    ".cpp",
+    ".cxx",
+    ".cu",
+    ".h",
+    ".hh",
+    ".hpp",
+    ".hxx",
+    ".inl",
+    ".ipp",
+}
+MAX_BATCH = 64
+
+
+def _git_files(repo_base, *args):
+    result = run(["git", *args], cwd=repo_base, stdout=PIPE, universal_newlines=True)
+    return [line for line in result.stdout.splitlines() if line]
+
+
+def changed_files(settings):
+    """returns the files selected by cmdline_format relative to repo_base
+
+    no arguments -- files that differ from format_base, plus untracked files
+    --cached -- files staged in the index
+    --all -- every tracked file
+    REF -- files that differ from REF, plus untracked files
+    """
+    repo_base = settings["repo_base"].value
+    args = settings["cmdline_format"].value
+    if "--all" in args:
+        return _git_files(repo_base, "ls-files")
+    if "--cached" in args:
+        return _git_files(
+            repo_base, "diff", "--cached", "--name-only", "--diff-filter=ACMR"
+        )
+    base = args[0] if args else settings["format_base"].value
+    return _git_files(
+        repo_base, "diff", "--name-only", "--diff-filter=ACMR", base
+    ) + _git_files(repo_base, "ls-files", "--others", "--exclude-standard")
+
+
+def _digest(path):
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def format_changed(settings):
+    """formats changed files in parallel batches, skipping files already known to be
+    formatted under the current clang-format version and configuration"""
+    repo_base = settings["repo_base"].value
+    candidates = sorted(
+        {
+            repo_base / path
+            for path in changed_files(settings)
+            if (repo_base / path).suffix in SUFFIXES and (repo_base / path).is_file()
+        }
+    )
+    if not candidates:
+        LOGGER.info("no C or C++ files changed")
+        return 0
+    if shutil.which("clang-format") is None:
+        print("m: clang-format is not installed")
+        return 1
+    version = run(["clang-format", "--version"], stdout=PIPE, universal_newlines=True)
+    configs = [
+        repo_base / path
+        for path in _git_files(
+            repo_base, "ls-files", "--", ".clang-format", "*/.clang-format"
+        )
+    ]
+    config = digest_files(configs, extra=[version.stdout])
+
+    cache_path = state_dir(settings) / "format.json"
+    cache = load_json(cache_path, {})
+    if cache.get("config") != config:
+        cache = {"config": config, "formatted": {}}
+
+    stale = [
+        path
+        for path in candidates
+        if cache["formatted"].get(str(path)) != _digest(path)
+    ]
+    LOGGER.info("formatting %d of %d changed files", len(stale), len(candidates))
+    if not stale:
+        return 0
+
+    jobs = settings["jobs"].value
+    size = min(MAX_BATCH, max(1, -(-len(stale) // jobs)))
+    batches = [stale[i : i + size] for i in range(0, len(stale), size)]
+    results = [
+        result.returncode
+        for result in run_all(
+            [
+                partial(
+                    run_async,
+                    ["clang-format", "-i", "--style=file", *map(str, batch)],
+                    cwd=repo_base,
+                    stdin=DEVNULL,
+                )
+                for batch in batches
+            ],
+            jobs,
+        )
+    ]
+
+    for batch, returncode in zip(batches, results):
+        if returncode == 0:
+            for path in batch:
+                cache["formatted"][str(path)] = _digest(path)
+    store_json(cache_path, cache)
+    return next((r for r in results if r), 0)
@@ -0,0 +1,199 @@
+"""runs clang-tidy over compile_commands.json, re-checking only changed translation units"""
+
+import hashlib
+import json
+import logging
+import re
+import shlex
+import shutil
+from functools import partial
+from pathlib import Path
+from .Process import run, run_all, run_async, PIPE, DEVNULL
+from .Cache import state_dir, load_json, store_json
+
+LOGGER = logging.getLogger(__name__)
+
+LAUNCHERS = {"ccache", "sccache"}
+DIAGNOSTIC = re.compile(
+    r"^(?P<file>.+?):(?P<line>\d+):(?P<col>\d+): (?P<severity>warning|error|note): "
+    r"(?P<message>.*?)(?: \[(?P<check>[^\]]+)\])?$"
+)
+
+
+def available():
+    """returns if clang-tidy is on the path"""
+    return shutil.which("clang-tidy") is not None
+
+
+def _compile_args(entry):
+    """returns the compiler invocation of a compile_commands.json entry"""
+    if "arguments" in entry:
+        args = list(entry["arguments"])
+    else:
+        args = shlex.split(entry["command"])
+    while args and Path(args[0]).name in LAUNCHERS:
+        args.pop(0)
+    return args
+
+
+def _preprocess_args(args):
+    """rewrites a compile command to write preprocessed output to stdout"""
+    result = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+            continue
+        if arg in ("-o", "-MF", "-MT", "-MQ"):
+            skip = True
+            continue
+        if arg in ("-c", "-MD", "-MMD") or arg.startswith("-o"):
+            continue
+        result.append(arg)
+    return [*result, "-E", "-o", "-"]
+
+
+def _tidy_configs(source, repo_base):
+    """returns the .clang-tidy files that can apply to source"""
+    configs = []
+    for directory in Path(source).parents:
+        if (directory / ".clang-tidy").exists():
+            configs.append(directory / ".clang-tidy")
+        if directory == repo_base:
+            break
+    return configs
+
+
+async def _cache_key(entry, source, repo_base, extra):
+    """hashes everything that can change clang-tidy's findings for one translation unit"""
+    args = _compile_args(entry)
+    hasher = hashlib.sha256()
+    for item in [*extra, *args]:
+        hasher.update(item.encode())
+        hasher.update(b"\0")
+    for config in _tidy_configs(source, repo_base):
+        hasher.update(config.read_bytes())
+    preprocessed = await run_async(
+        _preprocess_args(args),
+        cwd=entry["directory"],
+        stdin=DEVNULL,
+        stdout=PIPE,
+        stderr=DEVNULL,
+    )
+    if preprocessed.returncode != 0:
+        return None
+    hasher.update(preprocessed.stdout)
+    return hasher.hexdigest()
+
+
+def parse_diagnostics(output):
+    """groups clang-tidy output into diagnostics with their notes"""
+    diagnostics = []
+    for line in output.splitlines():
+        match = DIAGNOSTIC.match(line)
+        if match is None:
+            if diagnostics:
+                diagnostics[-1]["context"].append(line)
+            continue
+        if match.group("severity") == "note" and diagnostics:
+            diagnostics[-1]["context"].append(line)
+            continue
+        diagnostic = match.groupdict()
+        diagnostic["line"] = int(diagnostic["line"])
+        diagnostic["col"] = int(diagnostic["col"])
+        diagnostic["context"] = []
+        diagnostics.append(diagnostic)
+    return diagnostics
+
+
+async def _check(entry, source, settings, cache_dir, key_extra):
+    """returns the diagnostics for one translation unit, using the cache if possible"""
+    extra = settings["cmdline_tidy"].value
+    key = await _cache_key(entry, source, settings["repo_base"].value, key_extra)
+    cached = load_json(cache_dir / f"{key}.json") if key else None
+    if cached is not None:
+        return cached, True
+    result = await run_async(
+        ["clang-tidy", "-p", str(settings["build_dir"].value), str(source), *extra],
+        stdin=DEVNULL,
+        stdout=PIPE,
+        stderr=DEVNULL,
+        universal_newlines=True,
+    )
+    diagnostics = parse_diagnostics(result.stdout)
+    if key and result.returncode == 0:
+        store_json(cache_dir / f"{key}.json", diagnostics)
+    elif result.returncode != 0 and not diagnostics:
+        diagnostics = [
+            {
+                "file": str(source),
+                "line": 0,
+                "col": 0,
+                "severity": "error",
+                "message": f"clang-tidy exited with {result.returncode}",
+                "check": None,
+                "context": [],
+            }
+        ]
+    return diagnostics, False
+
+
+def tidy(settings):
+    """runs clang-tidy on every translation unit of the project in parallel"""
+    compile_commands = settings["build_dir"].value / "compile_commands.json"
+    if not compile_commands.exists():
+        print("no compile_commands.json in", settings["build_dir"].value)
+        return 1
+    with open(compile_commands) as infile:
+        entries = json.load(infile)
+
+    repo_base = settings["repo_base"].value.resolve()
+    build_dir = settings["build_dir"].value.resolve()
+    units = {}
+    for entry in entries:
+        source = (Path(entry["directory"]) / entry["file"]).resolve()
+        if repo_base in source.parents and build_dir not in source.parents:
+            units.setdefault(source, entry)
+
+    version = run(["clang-tidy", "--version"], stdout=PIPE, universal_newlines=True)
+    cache_dir = state_dir(settings, "tidy")
+    key_extra = [version.stdout, *settings["cmdline_tidy"].value]
+
+    findings = {}
+    checked = 0
+    results = run_all(
+        [
+            partial(_check, entry, source, settings, cache_dir, key_extra)
+            for source, entry in units.items()
+        ],
+        settings["jobs"].value,
+    )
+    for diagnostics, cached in results:
+        checked += not cached
+        for diagnostic in diagnostics:
+            key = (
+                diagnostic["file"],
+                diagnostic["line"],
+                diagnostic["col"],
+                diagnostic["severity"],
+                diagnostic["message"],
+                diagnostic["check"],
+            )
+            findings.setdefault(key, diagnostic)
+
+    for diagnostic in sorted(
+        findings.values(), key=lambda d: (d["file"], d["line"], d["col"])
+    ):
+        check = f" [{diagnostic['check']}]" if diagnostic["check"] else ""
+        print(
+            f"{diagnostic['file']}:{diagnostic['line']}:{diagnostic['col']}:"
+            f" {diagnostic['severity']}: {diagnostic['message']}{check}"
+        )
+        for line in diagnostic["context"]:
+            print(line)
+    errors = sum(d["severity"] == "error" for d in findings.values())
+    print(
+        f"m: {len(findings)} findings ({errors} errors) in {len(units)} translation units,"
+        f" {checked} re-checked"
+    )
+    return 1 if errors else 0
@@ -0,0 +1,222 @@
+"""reports how well sccache or ccache served each build and finds the compile commands
+that keep missing the cache"""
+
+import json
+import logging
+import shlex
+import statistics
+import time
+from .Process import run, PIPE, DEVNULL
+from .Cache import state_dir, load_json, store_json
+
+LOGGER = logging.getLogger(__name__)
+
+MAX_HISTORY = 100
+# builds with fewer cacheable compiles say nothing about the hit rate
+MIN_COMPILES = 10
+BASELINE_BUILDS = 10
+REGRESSION = 0.2
+# ccache counters that are neither hits, misses nor reasons a compile was not cached
+CCACHE_HITS = ("direct_cache_hit", "preprocessed_cache_hit")
+CCACHE_IGNORED = (
+    "cache_miss",
+    "direct_cache_miss",
+    "preprocessed_cache_miss",
+    "files_in_cache",
+    "cache_size_kibibyte",
+    "cleanups_performed",
+    "recache",
+    "stats_zeroed_timestamp",
+    "stats_updated_timestamp",
+    "called_for_link",
+    "called_for_preprocessing",
+    "no_input_file",
+    "autoconf_test",
+)
+CCACHE_IGNORED_PREFIXES = ("local_storage_", "remote_storage_", "primary_storage_")
+
+
+def launcher(cmake_cache):
+    """returns the compiler cache the build directory was configured with"""
+    for key in ("CMAKE_CXX_COMPILER_LAUNCHER", "CMAKE_C_COMPILER_LAUNCHER"):
+        value = cmake_cache.get(key, "")
+        for tool in ("sccache", "ccache"):
+            if value.rsplit("/", 1)[-1] == tool:
+                return value
+    return None
+
+
+def _count(value):
+    """sums an sccache counter, which is either a number or counts per language"""
+    if isinstance(value, dict):
+        return sum(_count(v) for v in value.get("counts", value).values())
+    return value if isinstance(value, int) else 0
+
+
+def _sccache_stats(tool):
+    result = run(
+        [tool, "--show-stats", "--stats-format=json"],
+        stdout=PIPE,
+        stderr=DEVNULL,
+        universal_newlines=True,
+    )
+    try:
+        stats = json.loads(result.stdout)["stats"]
+    except (ValueError, KeyError, TypeError):
+        return None
+    reasons = {
+        reason: _count(count) for reason, count in stats.get("not_cached", {}).items()
+    }
+    reasons["unsupported compiler"] = _count(
+        stats.get("requests_unsupported_compiler", 0)
+    )
+    reasons["compile failed"] = _count(stats.get("compile_fails", 0))
+    return {
+        "hits": _count(stats.get("cache_hits", 0)),
+        "misses": _count(stats.get("cache_misses", 0)),
+        "uncacheable": reasons,
+    }
+
+
+def _ccache_stats(tool):
+    result = run(
+        [tool, "--print-stats"], stdout=PIPE, stderr=DEVNULL, universal_newlines=True
+    )
+    if result.returncode != 0:
+        return None
+    counters = {}
+    for line in result.stdout.splitlines():
+        key, _, value = line.partition("\t")
+        if value.strip().isdigit():
+            counters[key] = int(value)
+    reasons = {
+        key.replace("_", " "): count
+        for key, count in counters.items()
+        if key not in CCACHE_HITS
+        and key not in CCACHE_IGNORED
+        and not key.startswith(CCACHE_IGNORED_PREFIXES)
+    }
+    return {
+        "hits": sum(counters.get(key, 0) for key in CCACHE_HITS),
+        "misses": counters.get("cache_miss", 0),
+        "uncacheable": reasons,
+    }
+
+
+def stats(tool):
+    """returns the cumulative hits, misses and uncacheable compiles by reason"""
+    if tool.rsplit("/", 1)[-1] == "sccache":
+        return _sccache_stats(tool)
+    return _ccache_stats(tool)
+
+
+def delta(before, after):
+    """returns the counters of what happened between two snapshots"""
+    reasons = {
+        reason: count - before["uncacheable"].get(reason, 0)
+        for reason, count in after["uncacheable"].items()
+    }
+    return {
+        "hits": after["hits"] - before["hits"],
+        "misses": after["misses"] - before["misses"],
+        "uncacheable": {
+            reason: count for reason, count in reasons.items() if count > 0
+        },
+    }
+
+
+def _rate(build):
+    total = build["hits"] + build["misses"]
+    return build["hits"] / total if total else None
+
+
+def record(settings, tool, before):
+    """prints and records what the cache did during the build that started at the
+    snapshot before; sccache's counters are shared by all builds on the machine, so
+    concurrent builds elsewhere show up in the numbers"""
+    after = stats(tool)
+    if before is None or after is None:
+        return None
+    build = delta(before, after)
+    compiles = build["hits"] + build["misses"] + sum(build["uncacheable"].values())
+    if compiles == 0:
+        return build
+    rate = _rate(build)
+    line = (
+        f"m: {tool.rsplit('/', 1)[-1]} {build['hits']} hits, {build['misses']} misses"
+    )
+    if rate is not None:
+        line += f" ({rate:.0%})"
+    if build["uncacheable"]:
+        reasons = sorted(build["uncacheable"].items(), key=lambda item: -item[1])
+        line += ", not cached: " + ", ".join(f"{n} {reason}" for reason, n in reasons)
+    print(line)
+
+    history_path = state_dir(settings) / "compiler_cache.json"
+    history = load_json(history_path, [])
+    previous = [
+        _rate(entry)
+        for entry in history
+        if entry["hits"] + entry["misses"] >= MIN_COMPILES
+    ][-BASELINE_BUILDS:]
+    if (
+        rate is not None
+        and build["hits"] + build["misses"] >= MIN_COMPILES
+        and previous
+        and rate < statistics.median(previous) - REGRESSION
+    ):
+        print(
+            f"m: the cache hit rate dropped to {rate:.0%} from a usual "
+            f"{statistics.median(previous):.0%}, run 'm a -c cache' to find the"
+            " compile commands that miss"
+        )
+    history.append({"time": time.time(), "tool": tool, **build})
+    store_json(history_path, history[-MAX_HISTORY:])
+    return build
+
+
+def _outcome(tool, args, cwd):
+    """runs one compile command and returns whether the cache hit, missed or could
+    not cache it, and why"""
+    before = stats(tool)
+    result = run(args, cwd=cwd, stdout=DEVNULL, stderr=DEVNULL)
+    after = stats(tool)
+    if result.returncode != 0 or before is None or after is None:
+        return "failed", None
+    change = delta(before, after)
+    if change["hits"]:
+        return "hit", None
+    if change["misses"]:
+        return "miss", None
+    if change["uncacheable"]:
+        return "uncacheable", ", ".join(change["uncacheable"])
+    return "not seen", None
+
+
+def diagnose(settings, tool):
+    """compiles every command of compile_commands.json twice and lists those that
+    the cache does not serve the second time, which points at things like __DATE__,
+    absolute paths in flags or unsupported options"""
+    database = settings["build_dir"].value / "compile_commands.json"
+    commands = load_json(database)
+    if commands is None:
+        print(f"m: {database} is missing, configure the project first")
+        return 1
+    problems = []
+    for entry in commands:
+        args = entry.get("arguments") or shlex.split(entry["command"])
+        # cmake leaves the compiler launcher out of the compilation database
+        if args[0].rsplit("/", 1)[-1] != tool.rsplit("/", 1)[-1]:
+            args = [tool, *args]
+        run(args, cwd=entry["directory"], stdout=DEVNULL, stderr=DEVNULL)
+        outcome, reason = _outcome(tool, args, entry["directory"])
+        LOGGER.debug("%s: %s", entry["file"], outcome)
+        if outcome != "hit":
+            problems.append((entry["file"], outcome, reason))
+    if not problems:
+        print(f"m: all {len(commands)} compile commands hit the cache when repeated")
+        return 0
+    print(f"m: {len(problems)} of {len(commands)} compile commands miss when repeated:")
+    for file, outcome, reason in problems:
+        print(f"  {outcome:11} {file}" + (f" ({reason})" if reason else ""))
+    return 1
@@ -1,13 +1,333 @@
+import fnmatch
+import json
+import logging
+import os
+import re
+import shutil
+import sys
 import typing
 from pathlib import Path
-from subprocess import run, DEVNULL
+from .Process import run, PIPE, DEVNULL
 from .Base import plugin, BasePlugin, PluginSupport, Setting
+from .Settings import Settings
+
+LOGGER = logging.getLogger(__name__)
+
+BUILDER = "m"
+CACHE_ROOT = "/m-cache"
+# named volumes that keep compiler and package caches between container builds,
+# mapped to the directory they are mounted at and the variable that points there
+VOLUMES = {
+    "m-ccache": ("ccache", "CCACHE_DIR"),
+    "m-sccache": ("sccache", "SCCACHE_DIR"),
+    "m-pip": ("pip", "PIP_CACHE_DIR"),
+}
+CARGO_VOLUMES = {"m-cargo-registry": "registry", "m-cargo-git": "git"}
+
+
+def _ignore_patterns(path):
+    """reads the patterns of a .dockerignore file"""
+    if not path.exists():
+        return []
+    patterns = []
+    for line in path.read_text().splitlines():
+        line = line.strip()
+        if line and not line.startswith("#"):
+            patterns.append(line)
+    return patterns
+
+
+def _ignored(relative, patterns):
+    """returns if a path relative to the context is excluded by dockerignore patterns;
+    the last matching pattern wins and a pattern that matches a directory excludes
+    everything below it"""
+    parts = relative.split("/")
+    prefixes = ["/".join(parts[: i + 1]) for i in range(len(parts))]
+    ignored = False
+    for pattern in patterns:
+        negated = pattern.startswith("!")
+        pattern = pattern.lstrip("!").strip("/")
+        if pattern.startswith("./"):
+            pattern = pattern[2:]
+        if any(fnmatch.fnmatchcase(prefix, pattern) for prefix in prefixes):
+            ignored = not negated
+    return ignored
+
+
+def context_size(repo_base, patterns):
+    """returns the bytes that would be sent as the build context and the largest top
+    level entries"""
+    total = 0
+    entries = {}
+    for root, dirs, files in os.walk(repo_base):
+        relative_root = Path(root).relative_to(repo_base).as_posix()
+        relative_root = "" if relative_root == "." else relative_root + "/"
+        # negated patterns can re-include files below an ignored directory, so only
+        # prune directories when there are none
+        if not any(p.startswith("!") for p in patterns):
+            dirs[:] = [d for d in dirs if not _ignored(relative_root + d, patterns)]
+        for name in files:
+            relative = relative_root + name
+            if _ignored(relative, patterns):
+                continue
+            try:
+                size = os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                continue
+            total += size
+            top = relative.split("/", 1)[0]
+            entries[top] = entries.get(top, 0) + size
+    largest = sorted(entries.items(), key=lambda item: -item[1])
+    return total, largest
 
 
 @plugin
 class Docker(BasePlugin):
+    def settings(self, current_settings) -> typing.List[Setting]:
+        """returns settings that this plugin is authoritative for"""
+        make_setting = self.get_settings_factory(priority=Setting.LOW)
+        name = re.sub(r"[^a-z0-9._-]+", "-", Settings.find_repo_base().name.lower())
+        return [
+            make_setting("docker", "docker"),
+            make_setting("docker_tag", f"m-{name.strip('.-_') or 'project'}:latest"),
+            make_setting("docker_context_warn_mb", 500),
+            make_setting("docker_build_args", []),
+            make_setting("docker_run_args", []),
+            make_setting("container", False),
+        ]
+
     def build(self, settings):
-        return run(["docker", "build", "."]).returncode
+        """builds the project's image; -c is meant for the other build systems of the
+        repository, arguments for docker go in docker_build_args"""
+        return self.build_image(settings)
+
+    def build_image(self, settings):
+        """builds the project's image with BuildKit, persisting the layer cache in the
+        build directory and leaving m's build directories out of the context"""
+        repo_base = settings["repo_base"].value
+        extra = settings["docker_build_args"].value
+        dockerfile = self.prepare_dockerfile(settings)
+        self.check_context(settings, dockerfile)
+        docker = settings["docker"].value
+        tag = settings["docker_tag"].value
+        if not self.has_buildx(settings):
+            LOGGER.info("docker buildx is unavailable, using the daemon's cache")
+            env = dict(os.environ, DOCKER_BUILDKIT="1")
+            return run(
+                [
+                    docker,
+                    "build",
+                    "-t",
+                    tag,
+                    "-f",
+                    str(dockerfile),
+                    *extra,
+                    str(repo_base),
+                ],
+                cwd=repo_base,
+                env=env,
+            ).returncode
+
+        self.ensure_builder(settings)
+        cache = settings["build_dir"].value / "docker_cache"
+        new_cache = cache.with_name(cache.name + ".new")
+        shutil.rmtree(new_cache, ignore_errors=True)
+        args = [
+            docker,
+            "buildx",
+            "build",
+            "--builder",
+            BUILDER,
+            "--load",
+            "-t",
+            tag,
+            "-f",
+            str(dockerfile),
+            f"--cache-to=type=local,dest={new_cache},mode=max",
+        ]
+        if (cache / "index.json").exists():
+            args.append(f"--cache-from=type=local,src={cache}")
+        result = run([*args, *extra, str(repo_base)], cwd=repo_base)
+        if result.returncode == 0 and new_cache.exists():
+            # the local exporter never prunes old blobs, so replace the cache instead of
+            # exporting into it
+            shutil.rmtree(cache, ignore_errors=True)
+            new_cache.rename(cache)
+        return result.returncode
+
+    @staticmethod
+    def has_buildx(settings) -> bool:
+        """returns if the docker cli has the buildx plugin"""
+        result = run(
+            [settings["docker"].value, "buildx", "version"],
+            stdout=DEVNULL,
+            stderr=DEVNULL,
+        )
+        return result.returncode == 0
+
+    @staticmethod
+    def ensure_builder(settings):
+        """creates a docker-container builder, the default docker driver can not export
+        its cache to a local directory"""
+        docker = settings["docker"].value
+        inspect = run(
+            [docker, "buildx", "inspect", BUILDER], stdout=DEVNULL, stderr=DEVNULL
+        )
+        if inspect.returncode != 0:
+            run(
+                [
+                    docker,
+                    "buildx",
+                    "create",
+                    "--name",
+                    BUILDER,
+                    "--driver",
+                    "docker-container",
+                ],
+                stdout=DEVNULL,
+            )
+
+    @staticmethod
+    def excluded_build_dirs(settings):
+        """returns dockerignore patterns for m's build directories inside the repo"""
+        repo_base = settings["repo_base"].value.resolve()
+        build_dir = settings["build_dir"].value.resolve()
+        if repo_base not in build_dir.parents:
+            return []
+        relative = build_dir.relative_to(repo_base).as_posix()
+        return [relative, f"{relative}_*"]
+
+    def prepare_dockerfile(self, settings):
+        """copies the Dockerfile next to an ignore file that adds m's build
+        directories to the repository's .dockerignore"""
+        repo_base = settings["repo_base"].value
+        build_dir = settings["build_dir"].value
+        build_dir.mkdir(exist_ok=True)
+        dockerfile = build_dir / "m.Dockerfile"
+        shutil.copyfile(repo_base / "Dockerfile", dockerfile)
+        # like docker, prefer the Dockerfile specific ignore file over .dockerignore
+        specific = repo_base / "Dockerfile.dockerignore"
+        patterns = [
+            *_ignore_patterns(
+                specific if specific.exists() else repo_base / ".dockerignore"
+            ),
+            *self.excluded_build_dirs(settings),
+        ]
+        ignore = dockerfile.with_name(dockerfile.name + ".dockerignore")
+        ignore.write_text("".join(f"{pattern}\n" for pattern in patterns))
+        return dockerfile
+
+    @staticmethod
+    def check_context(settings, dockerfile):
+        """warns if the build context is larger than docker_context_warn_mb"""
+        patterns = _ignore_patterns(
+            dockerfile.with_name(dockerfile.name + ".dockerignore")
+        )
+        total, largest = context_size(settings["repo_base"].value, patterns)
+        LOGGER.info("docker build context is %.1f MB", total / 2**20)
+        if total > settings["docker_context_warn_mb"].value * 2**20:
+            print(
+                f"m: the docker build context is {total / 2**20:.0f} MB, consider adding"
+                " these to .dockerignore:"
+            )
+            for name, size in largest[:5]:
+                if size < 2**20:
+                    break
+                print(f"  {name} ({size / 2**20:.0f} MB)")
+        return total
+
+    def container(self, settings, method):
+        """runs m inside the project's image with the repository and build directory
+        mounted at the same paths and the compiler and package caches in volumes; the
+        arguments given with -c are for the action inside, not for the image"""
+        returncode = self.build_image(settings)
+        if returncode != 0:
+            return returncode
+        docker = settings["docker"].value
+        tag = settings["docker_tag"].value
+        repo_base = settings["repo_base"].value.resolve()
+        build_dir = settings["build_dir"].value.resolve()
+        home = build_dir / ".m" / "container_home"
+        home.mkdir(parents=True, exist_ok=True)
+        m_package = Path(__file__).resolve().parents[1]
+
+        args = [docker, "run", "--rm", "--init"]
+        if sys.stdin.isatty() and sys.stdout.isatty():
+            args.append("-it")
+        args.extend(["-u", f"{os.getuid()}:{os.getgid()}"])
+        args.extend(["-v", f"{repo_base}:{repo_base}"])
+        if repo_base not in build_dir.parents:
+            args.extend(["-v", f"{build_dir}:{build_dir}"])
+        args.extend(["-v", f"{m_package}:/m-tool/m:ro", "-w", str(Path.cwd())])
+        args.extend(["-e", "PYTHONPATH=/m-tool", "-e", f"HOME={home}"])
+        args.extend(["-e", "M_IN_CONTAINER=1"])
+
+        volumes = {
+            name: (f"{CACHE_ROOT}/{directory}", variable)
+            for name, (directory, variable) in VOLUMES.items()
+        }
+        cargo_home = self.image_env(settings).get("CARGO_HOME")
+        if cargo_home is None:
+            cargo_home = f"{CACHE_ROOT}/cargo"
+            args.extend(["-e", f"CARGO_HOME={cargo_home}"])
+        for name, directory in CARGO_VOLUMES.items():
+            volumes[name] = (f"{cargo_home}/{directory}", None)
+        for name, (mount, variable) in volumes.items():
+            self.ensure_volume(settings, name)
+            args.extend(["-v", f"{name}:{mount}"])
+            if variable is not None:
+                args.extend(["-e", f"{variable}={mount}"])
+
+        args.extend(settings["docker_run_args"].value)
+        return run([*args, tag, "python3", "-m", "m", *sys.argv[1:]]).returncode
+
+    @staticmethod
+    def image_env(settings):
+        """returns the environment variables set by the project's image"""
+        result = run(
+            [
+                settings["docker"].value,
+                "image",
+                "inspect",
+                "--format",
+                "{{json .Config.Env}}",
+                settings["docker_tag"].value,
+            ],
+            stdout=PIPE,
+            universal_newlines=True,
+        )
+        try:
+            variables = json.loads(result.stdout) or []
+        except ValueError:
+            return {}
+        return dict(variable.split("=", 1) for variable in variables)
+
+    @staticmethod
+    def ensure_volume(settings, name):
+        """creates a named volume owned by the current user; new volumes belong to
+        root, which would leave the caches unwritable for the build"""
+        docker = settings["docker"].value
+        inspect = run(
+            [docker, "volume", "inspect", name], stdout=DEVNULL, stderr=DEVNULL
+        )
+        if inspect.returncode == 0:
+            return
+        run([docker, "volume", "create", name], stdout=DEVNULL)
+        run(
+            [
+                docker,
+                "run",
+                "--rm",
+                "-u",
+                "0",
+                "-v",
+                f"{name}:/volume",
+                settings["docker_tag"].value,
+                "chown",
+                f"{os.getuid()}:{os.getgid()}",
+                "/volume",
+            ]
+        )
 
     @staticmethod
     def _supported(settings):
@@ -25,6 +345,22 @@ class Docker(BasePlugin):
             state = PluginSupport.DEFAULT_MAIN
         else:
             state = PluginSupport.NOT_ENABLED_BY_REPOSITORY
+
+        if (Settings.find_repo_base() / "Dockerfile").exists():
+            settings_state = PluginSupport.DEFAULT_AFTER_MAIN
+        else:
+            settings_state = PluginSupport.NOT_ENABLED_BY_REPOSITORY
+        if (
+            state == PluginSupport.DEFAULT_MAIN
+            and settings.get("container")
+            and settings["container"].value
+            and not os.environ.get("M_IN_CONTAINER")
+        ):
+            container_state = PluginSupport.DEFAULT_MAIN
+        else:
+            container_state = PluginSupport.NOT_SUPPORTED
         return {
+            "settings": settings_state,
             "build": state,
+            "container": container_state,
         }
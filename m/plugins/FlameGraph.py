@@ -0,0 +1,310 @@
+"""records a command with perf or py-spy, folds the stacks and writes flamegraphs, a
+table of the hottest functions and a differential flamegraph against the profile of
+the same command at the previous revision"""
+
+import hashlib
+import logging
+import os
+import re
+import shutil
+import zlib
+from collections import Counter
+from jinja2 import Environment, PackageLoader
+from .Process import run, PIPE, DEVNULL
+from .Cache import state_dir, load_json, store_json
+from . import Pgo
+
+LOGGER = logging.getLogger(__name__)
+
+FRAME_POINTER_FLAGS = "-fno-omit-frame-pointer -mno-omit-leaf-frame-pointer"
+FREQUENCY = 999
+TOP = 20
+KEEP_PROFILES = 10
+WIDTH = 1200
+FRAME_HEIGHT = 16
+MIN_WIDTH = 0.1
+CHAR_WIDTH = 7
+PERF_HEADER = re.compile(r"^(\S.*?)\s+\d+(?:/\d+)?\s+(?:\[\d+\]\s+)?[\d.]+:")
+OFFSET = re.compile(r"\+0x[0-9a-f]+$")
+
+
+def resolve_target(build_dir, command):
+    """replaces a bare target name at the start of command with the path of the
+    executable of that name in build_dir"""
+    if not command or "/" in command[0]:
+        return command
+    for path in [build_dir / command[0], *build_dir.rglob(command[0])]:
+        if path.is_file() and os.access(path, os.X_OK):
+            return [str(path), *command[1:]]
+    return command
+
+
+def python_command(command, python):
+    """returns the command that runs a python script or module with python"""
+    if not command:
+        return [*python, "-m", "pytest", "-q"]
+    if command[0].endswith(".py") or command[0] == "-m":
+        return [*python, *command]
+    return command
+
+
+def fold_perf(lines):
+    """folds the output of perf script into semicolon separated stacks, root first,
+    with the number of samples of each"""
+    folded = Counter()
+    comm = None
+    frames = []
+    for line in lines:
+        if not line.strip():
+            if comm is not None:
+                folded[";".join([comm, *reversed(frames)])] += 1
+            comm = None
+            frames = []
+        elif not line[0].isspace():
+            match = PERF_HEADER.match(line)
+            comm = match.group(1) if match else line.split(None, 1)[0]
+        else:
+            parts = line.strip().split(None, 1)
+            if len(parts) < 2:
+                continue
+            symbol, _, dso = parts[1].rpartition(" (")
+            symbol = OFFSET.sub("", symbol or parts[1])
+            if symbol == "[unknown]":
+                symbol = "[{}]".format(os.path.basename(dso.rstrip(")")) or "unknown")
+            frames.append(symbol)
+    if comm is not None:
+        folded[";".join([comm, *reversed(frames)])] += 1
+    return folded
+
+
+def read_folded(path):
+    """reads stacks in the folded format that py-spy and stackcollapse write"""
+    folded = Counter()
+    try:
+        with open(path) as infile:
+            for line in infile:
+                stack, _, count = line.rstrip("\n").rpartition(" ")
+                if stack and count.isdigit():
+                    folded[stack] += int(count)
+    except OSError:
+        pass
+    return folded
+
+
+def write_folded(path, folded):
+    with open(path, "w") as outfile:
+        for stack, count in sorted(folded.items()):
+            outfile.write(f"{stack} {count}\n")
+
+
+def record(settings, command, cwd, env=None, python=False):
+    """runs command under the profiler and returns its exit code and folded stacks"""
+    profiler = "py-spy" if python else "perf"
+    if shutil.which(profiler) is None:
+        print(f"m: {profiler} is not installed")
+        return 1, Counter()
+    profile_dir = state_dir(settings, "profile")
+    if python:
+        output = profile_dir / "py-spy.folded"
+        args = [
+            "py-spy",
+            "record",
+            "--format",
+            "raw",
+            "--subprocesses",
+            "--rate",
+            str(FREQUENCY),
+            "-o",
+            str(output),
+            "--",
+            *command,
+        ]
+        returncode = run(args, cwd=cwd, env=env).returncode
+        return returncode, read_folded(output)
+
+    data = profile_dir / "perf.data"
+    args = ["perf", "record", "-F", str(FREQUENCY), "--call-graph", "fp"]
+    returncode = run(
+        [*args, "-o", str(data), "--", *command], cwd=cwd, env=env
+    ).returncode
+    if returncode:
+        return returncode, Counter()
+    script = run(
+        ["perf", "script", "-i", str(data)],
+        stdout=PIPE,
+        stderr=DEVNULL,
+        universal_newlines=True,
+        errors="replace",
+    )
+    return returncode, fold_perf(script.stdout.splitlines())
+
+
+def _tree(folded):
+    root = {"name": "all", "value": 0, "children": {}}
+    for stack, count in folded.items():
+        node = root
+        node["value"] += count
+        for frame in stack.split(";"):
+            node = node["children"].setdefault(
+                frame, {"name": frame, "value": 0, "children": {}}
+            )
+            node["value"] += count
+    return root
+
+
+def _color(name, delta=None):
+    """returns a warm color that is stable for name, or for differential graphs red
+    for frames that grew and blue for frames that shrank"""
+    if delta is not None:
+        shade = 255 - int(200 * min(1.0, abs(delta)))
+        return f"rgb(255,{shade},{shade})" if delta > 0 else f"rgb({shade},{shade},255)"
+    digest = zlib.crc32(name.encode())
+    return "rgb({},{},{})".format(
+        205 + digest % 50, (digest >> 8) % 230, (digest >> 16) % 55
+    )
+
+
+def layout(folded, baseline=None):
+    """returns the frames of the flamegraph of folded; with a baseline each frame is
+    colored by how its share of the samples changed"""
+    root = _tree(folded)
+    base_root = _tree(baseline) if baseline else None
+    scale = root["value"] / base_root["value"] if base_root else 1
+    frames = []
+    deltas = []
+
+    def visit(node, base, x, depth):
+        width = node["value"] / root["value"] * WIDTH
+        if width < MIN_WIDTH:
+            return
+        frame = {
+            "name": node["name"],
+            "samples": node["value"],
+            "percent": 100 * node["value"] / root["value"],
+            "x": x,
+            "depth": depth,
+            "width": width,
+        }
+        if base_root is not None:
+            frame["delta"] = node["value"] - (base["value"] * scale if base else 0)
+            deltas.append(abs(frame["delta"]))
+        frames.append(frame)
+        for name in sorted(node["children"]):
+            child = node["children"][name]
+            child_base = base["children"].get(name) if base else None
+            visit(child, child_base, x, depth + 1)
+            x += child["value"] / root["value"] * WIDTH
+
+    visit(root, base_root, 0.0, 0)
+    largest = max(deltas, default=0) or 1
+    height = (max((f["depth"] for f in frames), default=0) + 1) * FRAME_HEIGHT
+    for frame in frames:
+        delta = frame.get("delta")
+        frame["color"] = _color(
+            frame["name"], None if delta is None else delta / largest
+        )
+        frame["y"] = height - (frame["depth"] + 1) * FRAME_HEIGHT
+        chars = int(frame["width"] / CHAR_WIDTH)
+        name = frame["name"]
+        frame["label"] = name if len(name) <= chars else name[: max(chars - 2, 0)]
+        if frame["label"] and frame["label"] != name:
+            frame["label"] += ".."
+    return frames, height
+
+
+def write_svg(path, title, folded, baseline=None):
+    """writes the flamegraph of folded to path"""
+    frames, height = layout(folded, baseline)
+    template_env = Environment(loader=PackageLoader("m", "templates"), autoescape=True)
+    render = template_env.get_template("profile/flamegraph.svg.j2").render(
+        title=title,
+        frames=frames,
+        width=WIDTH,
+        height=height,
+        frame_height=FRAME_HEIGHT,
+    )
+    with open(path, "w") as outfile:
+        outfile.write(render)
+    return path
+
+
+def hottest(folded, count=TOP):
+    """returns the functions with the most samples at the top of the stack, with the
+    share of samples they appear in anywhere in the stack"""
+    total = sum(folded.values()) or 1
+    own = Counter()
+    inclusive = Counter()
+    for stack, samples in folded.items():
+        frames = stack.split(";")[1:] or stack.split(";")
+        own[frames[-1]] += samples
+        for frame in set(frames):
+            inclusive[frame] += samples
+    return [
+        (name, 100 * samples / total, 100 * inclusive[name] / total)
+        for name, samples in own.most_common(count)
+    ]
+
+
+def print_hottest(rows):
+    print(f"{'self':>7} {'total':>7}  function")
+    for name, own, inclusive in rows:
+        print(f"{own:6.1f}% {inclusive:6.1f}%  {name}")
+
+
+def _store(settings, key, revision, folded):
+    """keeps the folded stacks of this run and returns those of the most recent run
+    of the same command at another revision"""
+    profile_dir = state_dir(settings, "profile")
+    index_path = profile_dir / "index.json"
+    index = load_json(index_path, {})
+    runs = [entry for entry in index.get(key, []) if entry["revision"] != revision]
+    previous = runs[-1] if runs else None
+    name = f"{key}-{hashlib.sha256(revision.encode()).hexdigest()[:12]}.folded"
+    write_folded(profile_dir / name, folded)
+    runs.append({"revision": revision, "file": name})
+    for stale in runs[:-KEEP_PROFILES]:
+        (profile_dir / stale["file"]).unlink(missing_ok=True)
+    index[key] = runs[-KEEP_PROFILES:]
+    store_json(index_path, index)
+    if previous is None:
+        return None, None
+    return previous["revision"], read_folded(profile_dir / previous["file"])
+
+
+def _short(revision):
+    commit, _, dirty = revision.partition("-dirty-")
+    return commit[:12] + (f"+{dirty[:6]}" if dirty else "")
+
+
+def profile(settings, command, cwd, env=None, python=False):
+    """profiles command, writes build/m_profile.svg and, if the command was profiled
+    at another revision before, build/m_profile_diff.svg"""
+    returncode, folded = record(settings, command, cwd, env, python)
+    if not folded:
+        if not returncode:
+            print("m: no samples were recorded")
+        return returncode or 1
+    if returncode:
+        LOGGER.warning("the profiled command exited with %d", returncode)
+    build_dir = settings["build_dir"].value
+    title = " ".join(command)
+    print_hottest(hottest(folded))
+    print(
+        "\nflamegraph written to", write_svg(build_dir / "m_profile.svg", title, folded)
+    )
+
+    key = hashlib.sha256("\0".join(command).encode()).hexdigest()[:12]
+    revision = Pgo.revision(settings["repo_base"].value) or "worktree"
+    previous_revision, previous = _store(settings, key, revision, folded)
+    if previous:
+        path = write_svg(
+            build_dir / "m_profile_diff.svg",
+            f"{title} ({_short(previous_revision)} to {_short(revision)})",
+            folded,
+            previous,
+        )
+        print(
+            f"differential flamegraph against {_short(previous_revision)} written to",
+            path,
+        )
+    return returncode
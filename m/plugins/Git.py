@@ -1,5 +1,5 @@
 import typing
-from subprocess import run, PIPE
+from .Process import run, PIPE
 from .Base import plugin, BasePlugin, Setting
 
 
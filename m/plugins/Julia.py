@@ -1,13 +1,25 @@
+import json
+import typing
 from os import chdir, execvp
-from subprocess import run, DEVNULL
-from .Base import plugin, BasePlugin, PluginSupport
+from .Process import run, DEVNULL
+from .Base import plugin, BasePlugin, PluginSupport, Setting
+from .Settings import Settings
+from . import Sysimage, JuliaServer
 
 
 @plugin
 class JuliaPlugin(BasePlugin):
+    def settings(self, current_settings) -> typing.List[Setting]:
+        """returns settings that this plugin is authoritative for"""
+        make_setting = self.get_settings_factory(priority=Setting.LOW)
+        return [
+            make_setting("julia_sysimage", "deps"),
+            make_setting("julia_server", False),
+        ]
+
     def build(self, settings):
         """compiles the source code or a subset thereof"""
-        return run(
+        returncode = run(
             [
                 "julia",
                 "--project",
@@ -17,23 +29,58 @@ class JuliaPlugin(BasePlugin):
             ],
             cwd=settings["repo_base"].value,
         ).returncode
+        if returncode == 0:
+            Sysimage.sysimage(settings)
+        return returncode
 
     def test(self, settings):
         """runs automated tests on source code or a subset there of"""
+        if settings["julia_server"].value:
+            test_dir = settings["repo_base"].value / "test"
+            returncode = JuliaServer.request(
+                settings,
+                test_dir / "runtests.jl",
+                settings["cmdline_test"].value,
+                cwd=test_dir,
+            )
+            if returncode is not None:
+                return returncode
+        julia_args = Sysimage.julia_args(settings)
+        test_args = f"; julia_args={json.dumps(julia_args)}" if julia_args else ""
         return run(
             [
                 "julia",
                 "--project",
                 "-e",
-                "using Pkg; Pkg.test()",
+                f"using Pkg; Pkg.test({test_args})",
                 *settings["cmdline_test"].value,
             ],
             cwd=settings["repo_base"].value,
         ).returncode
 
+    def run(self, settings):
+        """runs a script with the project's environment"""
+        args = settings["cmdline_run"].value
+        if settings["julia_server"].value and args:
+            repo_base = settings["repo_base"].value
+            returncode = JuliaServer.request(
+                settings, repo_base / args[0], args[1:], cwd=repo_base
+            )
+            if returncode is not None:
+                return returncode
+        return run(
+            [
+                "julia",
+                "--project",
+                *Sysimage.julia_args(settings),
+                *settings["cmdline_run"].value,
+            ],
+            cwd=settings["repo_base"].value,
+        ).returncode
+
     def repl(self, settings):
+        args = ["julia", "--project", *Sysimage.julia_args(settings)]
         chdir(settings["repo_base"].value)
-        args = ["julia", "--project"]
         execvp(args[0], args)
 
     @staticmethod
@@ -47,8 +94,15 @@ class JuliaPlugin(BasePlugin):
         else:
             state = PluginSupport.NOT_ENABLED_BY_REPOSITORY
 
+        if (Settings.find_repo_base() / "Project.toml").exists():
+            settings_state = PluginSupport.DEFAULT_AFTER_MAIN
+        else:
+            settings_state = PluginSupport.NOT_ENABLED_BY_REPOSITORY
+
         return {
+            "settings": settings_state,
             "repl": state,
             "build": state,
             "test": state,
+            "run": state,
         }
@@ -0,0 +1,154 @@
+"""keeps a julia process with the project's dependencies loaded and runs tests and
+scripts in it over a unix socket"""
+
+import hashlib
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+from .Process import Popen, STDOUT, DEVNULL
+from jinja2 import Environment, PackageLoader
+from .Cache import state_dir, user_cache_dir, digest_files, load_json, store_json
+from . import Sysimage
+
+LOGGER = logging.getLogger(__name__)
+
+SENTINEL = "\0m-exit:"
+STARTUP_TIMEOUT = 600
+POLL_INTERVAL = 0.1
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _socket_path(repo_base):
+    """returns the socket of the server for repo_base; it lives outside of the build
+    directory because unix socket paths are limited to about 100 characters"""
+    name = hashlib.sha256(str(repo_base.resolve()).encode()).hexdigest()[:16]
+    return user_cache_dir("julia", "servers") / f"{name}.sock"
+
+
+def _script(settings, socket_path):
+    repo_base = settings["repo_base"].value
+    template_env = Environment(loader=PackageLoader("m", "templates"))
+    return template_env.get_template("julia/server.jl.j2").render(
+        project=str(repo_base),
+        name=Sysimage.project_name(repo_base),
+        tool_env=str(user_cache_dir("julia", "revise")),
+        test_project=str(repo_base / "test" / "Project.toml"),
+        socket=str(socket_path),
+        sentinel=SENTINEL,
+    )
+
+
+def _stop(state):
+    """stops the server described by state"""
+    if state.get("pid") and _alive(state["pid"]):
+        LOGGER.info("stopping julia server %d", state["pid"])
+        os.killpg(state["pid"], signal.SIGTERM)
+    if state.get("socket"):
+        try:
+            os.unlink(state["socket"])
+        except FileNotFoundError:
+            pass
+
+
+def _start(settings, state_path, key, script, socket_path, julia_args):
+    """starts a server and waits until it listens on its socket"""
+    server_dir = state_dir(settings, "julia_server")
+    script_path = server_dir / "server.jl"
+    script_path.write_text(script)
+    with open(server_dir / "server.log", "w") as log:
+        proc = Popen(
+            [
+                "julia",
+                "--project",
+                "--startup-file=no",
+                *julia_args,
+                str(script_path),
+            ],
+            cwd=settings["repo_base"].value,
+            stdin=DEVNULL,
+            stdout=log,
+            stderr=STDOUT,
+            start_new_session=True,
+        )
+    state = {"pid": proc.pid, "key": key, "socket": str(socket_path)}
+    store_json(state_path, state)
+    print("m: starting a julia server, see", server_dir / "server.log")
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while not socket_path.exists():
+        if proc.poll() is not None or time.monotonic() > deadline:
+            _stop(state)
+            return None
+        time.sleep(POLL_INTERVAL)
+    return state
+
+
+def server(settings):
+    """returns the state of a server for the current environment, restarting the
+    server if Project.toml or Manifest.toml changed since it was started"""
+    repo_base = settings["repo_base"].value
+    socket_path = _socket_path(repo_base)
+    script = _script(settings, socket_path)
+    # revise cannot update code that was compiled into the sysimage
+    if settings["julia_sysimage"].value == "project":
+        julia_args = []
+    else:
+        julia_args = Sysimage.julia_args(settings)
+    key = digest_files(
+        [
+            path
+            for path in (
+                repo_base / "Project.toml",
+                repo_base / "Manifest.toml",
+                repo_base / "test" / "Project.toml",
+            )
+            if path.exists()
+        ],
+        extra=[Sysimage.julia_version(), script, *julia_args],
+    )
+    state_path = state_dir(settings) / "julia_server.json"
+    state = load_json(state_path, {})
+    if state.get("key") == key and _alive(state["pid"]) and socket_path.exists():
+        return state
+    _stop(state)
+    socket_path.unlink(missing_ok=True)
+    return _start(settings, state_path, key, script, socket_path, julia_args)
+
+
+def request(settings, file, args, cwd):
+    """runs file with args from cwd in a fresh module of the server and returns its
+    exit code, or None if no server could be started"""
+    state = server(settings)
+    if state is None:
+        LOGGER.warning("could not start a julia server, running julia directly")
+        return None
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        try:
+            conn.connect(state["socket"])
+        except OSError as error:
+            LOGGER.warning("could not connect to the julia server: %s", error)
+            _stop(state)
+            return None
+        message = "\0".join([str(cwd), str(file), *args])
+        conn.sendall(f"{message}\n".encode())
+        with conn.makefile("r", errors="replace") as lines:
+            for line in lines:
+                if SENTINEL in line:
+                    output, code = line.split(SENTINEL, 1)
+                    sys.stdout.write(output)
+                    return int(code)
+                sys.stdout.write(line)
+                sys.stdout.flush()
+    print("m: the julia server exited before finishing the request")
+    return 1
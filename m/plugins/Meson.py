@@ -1,5 +1,14 @@
-from subprocess import run
+from .Process import run
+import json
+import os
 from .Base import plugin, BasePlugin, PluginSupport
+from .Settings import Settings
+from . import BuildLog
+from . import ClangFormat
+from . import ClangTidy
+from . import FlameGraph
+from . import Progress
+from . import TimeTrace
 
 
 @plugin
@@ -23,21 +32,32 @@ class MesonPlugin(BasePlugin):
             (settings["build_dir"].value / "build.ninja").exists()
         )
 
+    @staticmethod
+    def build_options(build_dir):
+        """returns the values of the options a build directory was configured with"""
+        try:
+            with open(build_dir / "meson-info" / "intro-buildoptions.json") as infile:
+                return {option["name"]: option["value"] for option in json.load(infile)}
+        except (OSError, ValueError, KeyError, TypeError):
+            return {}
+
     def build(self, settings):
         """compiles the source code or a subset thereof"""
         self.configure(settings)
 
         if self.is_configured(settings):
             print("m[1]: Entering directory", str(settings["build_dir"].value))
-            return run(
+            return Progress.run_with_eta(
                 [
                     "ninja",
                     "-C",
                     str(settings["build_dir"].value),
                     *settings["cmdline_build"].value,
                 ],
+                settings,
+                "ninja",
                 cwd=settings["repo_base"].value,
-            ).returncode
+            )
         else:
             print("failed to configure")
             return 1
@@ -48,6 +68,8 @@ class MesonPlugin(BasePlugin):
 
         if self.is_configured(settings):
             print("m[1]: Entering directory", str(settings["build_dir"].value))
+            if ClangTidy.available():
+                return ClangTidy.tidy(settings)
             return run(
                 [
                     "ninja",
@@ -107,6 +129,10 @@ class MesonPlugin(BasePlugin):
             print("failed to configure")
             return 1
 
+    def format(self, settings):
+        """runs clang-format on the files that changed"""
+        return ClangFormat.format_changed(settings)
+
     def install(self, settings):
         """cleans source code or a subset there of"""
         self.configure(settings)
@@ -118,6 +144,88 @@ class MesonPlugin(BasePlugin):
             print("failed to configure")
             return 1
 
+    def analyze(self, settings):
+        """reports where the time of the last build went"""
+        args = settings["cmdline_analyze"].value
+        if args and args[0].startswith("t"):
+            return self._analyze_time_trace(settings)
+        return BuildLog.analyze_ninja(settings)
+
+    def _analyze_time_trace(self, settings):
+        """builds a side build directory with -ftime-trace and aggregates the traces"""
+        side_dir = Settings.side_build_dir(settings, "timetrace")
+        if not (side_dir / "build.ninja").exists():
+            env = dict(os.environ)
+            if "clang" not in env.get("CC", ""):
+                env["CC"] = "clang"
+            if "clang" not in env.get("CXX", ""):
+                env["CXX"] = "clang++"
+            returncode = run(
+                [
+                    "meson",
+                    "setup",
+                    str(side_dir),
+                    "-Dc_args=-ftime-trace",
+                    "-Dcpp_args=-ftime-trace",
+                    *settings["cmdline_configure"].value,
+                ],
+                cwd=settings["repo_base"].value,
+                env=env,
+            ).returncode
+            if returncode:
+                return returncode
+
+        returncode = run(
+            ["ninja", "-C", str(side_dir), "-j", str(settings["jobs"].value)]
+        ).returncode
+        if returncode:
+            return returncode
+        return TimeTrace.analyze(settings, side_dir)
+
+    def profile(self, settings):
+        """builds a side build directory with frame pointers and debug info and runs
+        the target or command given with -c under perf"""
+        command = settings["cmdline_profile"].value
+        if not command:
+            print("m: pass the target or command to profile, e.g. m profile -c app")
+            return 1
+        side_dir = Settings.side_build_dir(settings, "profile")
+        flags = FlameGraph.FRAME_POINTER_FLAGS
+        options = [
+            "-Dbuildtype=debugoptimized",
+            f"-Dc_args={flags}",
+            f"-Dcpp_args={flags}",
+        ]
+        if not (side_dir / "build.ninja").exists():
+            returncode = run(
+                [
+                    "meson",
+                    "setup",
+                    str(side_dir),
+                    *options,
+                    *settings["cmdline_configure"].value,
+                ],
+                cwd=settings["repo_base"].value,
+            ).returncode
+        elif any(
+            self.build_options(side_dir).get(name, flags.split()) != flags.split()
+            for name in ("c_args", "cpp_args")
+        ):
+            # the side directory was configured with other flags, e.g. by an older m
+            returncode = run(["meson", "configure", str(side_dir), *options]).returncode
+        else:
+            returncode = 0
+        if returncode:
+            return returncode
+
+        returncode = run(
+            ["ninja", "-C", str(side_dir), "-j", str(settings["jobs"].value)]
+        ).returncode
+        if returncode:
+            return returncode
+        command = FlameGraph.resolve_target(side_dir, command)
+        return FlameGraph.profile(settings, command, side_dir)
+
     def generate(self, settings):
         """generates a blank project"""
         return run(
@@ -141,7 +249,10 @@ class MesonPlugin(BasePlugin):
             "test": state,
             "clean": state,
             "install": state,
+            "format": state,
             "tidy": state,
             "bench": state,
+            "analyze": state,
+            "profile": state,
             "generate": PluginSupport.NOT_ENABLED_BY_DEFAULT,
         }
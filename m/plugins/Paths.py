@@ -0,0 +1,20 @@
+"""where m keeps its state; kept apart from Cache so that Process, which Cache runs
+git with, can use it too"""
+
+import os
+from pathlib import Path
+
+
+def state_dir(settings, *parts) -> Path:
+    """returns (and creates) a directory under build_dir used to persist m's state"""
+    path = Path(settings["build_dir"].value, ".m", *parts)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def user_cache_dir(*parts) -> Path:
+    """returns (and creates) a directory for state shared between repositories"""
+    base = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+    path = base.joinpath("m", *parts)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
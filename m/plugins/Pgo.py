@@ -0,0 +1,156 @@
+"""profile guided optimization: builds an instrumented variant, trains it, merges the
+raw profiles and compares an optimized build against a plain release build"""
+
+import hashlib
+import logging
+import shlex
+import shutil
+import time
+from .Process import run, PIPE, DEVNULL
+from .Cache import state_dir, load_json, store_json, source_digest
+
+LOGGER = logging.getLogger(__name__)
+
+KEEP_PROFILES = 10
+MAX_HISTORY = 50
+
+
+def revision(repo_base):
+    """returns the commit of repo_base, suffixed with a hash of the uncommitted changes
+    so that a dirty tree never reuses the profile of its clean commit"""
+    head = run(
+        ["git", "rev-parse", "HEAD"],
+        cwd=repo_base,
+        stdout=PIPE,
+        stderr=DEVNULL,
+        universal_newlines=True,
+    )
+    if head.returncode != 0:
+        return None
+    diff = run(["git", "diff", "HEAD"], cwd=repo_base, stdout=PIPE, stderr=DEVNULL)
+    commit = head.stdout.strip()
+    if diff.stdout:
+        return f"{commit}-dirty-{hashlib.sha256(diff.stdout).hexdigest()[:12]}"
+    return commit
+
+
+def profile_key(settings, *extra):
+    """returns the key that a merged profile is cached under, the source revision plus
+    extra strings such as the compiler version and the training command"""
+    repo_base = settings["repo_base"].value
+    source = revision(repo_base) or source_digest(repo_base, ".")
+    hasher = hashlib.sha256(source.encode())
+    for item in extra:
+        hasher.update(b"\0" + str(item).encode())
+    return hasher.hexdigest()[:16]
+
+
+def train_command(settings):
+    """returns the pgo_train setting as an argument list, or None if it is unset"""
+    command = settings["pgo_train"].value
+    if not command:
+        return None
+    return shlex.split(command) if isinstance(command, str) else list(command)
+
+
+def timed(function, *args):
+    """returns the result of calling function and the seconds it took"""
+    start = time.monotonic()
+    result = function(*args)
+    return result, time.monotonic() - start
+
+
+def merge(tool, raw_dir, output):
+    """merges the .profraw files under raw_dir into output"""
+    raw = sorted(str(path) for path in raw_dir.rglob("*.profraw"))
+    if not raw:
+        print(f"m: training wrote no profiles to {raw_dir}")
+        return 1
+    tmp = output.with_name(output.name + ".tmp")
+    returncode = run([tool, "merge", "-o", str(tmp), *raw]).returncode
+    if returncode == 0:
+        tmp.replace(output)
+    else:
+        print(
+            f"m: {tool} could not merge the profiles, its llvm version has to match"
+            " the compiler's, see the llvm_profdata setting"
+        )
+    return returncode
+
+
+def _prune(profile_dir):
+    """removes all but the most recently used profiles"""
+    profiles = sorted(
+        profile_dir.glob("*.profdata"), key=lambda p: p.stat().st_mtime, reverse=True
+    )
+    for stale in profiles[KEEP_PROFILES:]:
+        stale.unlink()
+
+
+def profile(settings, tool, key, build, train):
+    """returns the merged profile for key, reusing the one of a previous run if the
+    source revision did not change, or None if it could not be produced
+
+    build(stage, path) builds the instrumented variant writing raw profiles to path
+    and train(stage) runs the training workload in it.
+    """
+    profile_dir = state_dir(settings, "pgo")
+    profile_path = profile_dir / f"{key}.profdata"
+    if profile_path.exists():
+        print(f"m: reusing the profile of this revision, {profile_path}")
+        profile_path.touch()
+        return profile_path
+
+    raw_dir = profile_dir / "profraw"
+    shutil.rmtree(raw_dir, ignore_errors=True)
+    raw_dir.mkdir()
+    if build("gen", raw_dir) != 0:
+        print("m: failed to build the instrumented variant")
+        return None
+    if train("gen") != 0:
+        print("m: the training run failed")
+        return None
+    if merge(tool, raw_dir, profile_path) != 0:
+        return None
+    shutil.rmtree(raw_dir, ignore_errors=True)
+    _prune(profile_dir)
+    return profile_path
+
+
+def report(settings, key, baseline, optimized):
+    """prints the speedup of the training workload and records it in the history"""
+    speedup = baseline / optimized if optimized > 0 else 0.0
+    print(f"m: release  {baseline:8.2f}s")
+    print(f"m: pgo      {optimized:8.2f}s")
+    print(f"m: speedup  {speedup:8.2f}x")
+    history_path = state_dir(settings) / "pgo.json"
+    history = load_json(history_path, [])
+    history.append(
+        {
+            "key": key,
+            "time": time.time(),
+            "baseline": round(baseline, 3),
+            "pgo": round(optimized, 3),
+        }
+    )
+    store_json(history_path, history[-MAX_HISTORY:])
+    return speedup
+
+
+def pgo(settings, tool, key, build, train):
+    """runs the whole workflow, build(stage, profile) builds the gen, base or use
+    variant and train(stage) runs the training workload in that variant"""
+    profile_path = profile(settings, tool, key, build, train)
+    if profile_path is None:
+        return 1
+    if build("base", None) != 0 or build("use", profile_path) != 0:
+        print("m: failed to build the release variants")
+        return 1
+    # time the variants right after each other so both see similar machine load
+    base_code, baseline = timed(train, "base")
+    use_code, optimized = timed(train, "use")
+    if base_code != 0 or use_code != 0:
+        print("m: the training workload failed in a release variant")
+        return base_code or use_code
+    report(settings, key, baseline, optimized)
+    return 0
@@ -1,10 +1,74 @@
-from subprocess import run
-from .Base import plugin, BasePlugin, PluginSupport
+from .Process import run, run_all, run_async, PIPE, STDOUT, DEVNULL
+from pathlib import Path
+from functools import partial
+import os
+import typing
+from .Base import plugin, BasePlugin, PluginSupport, Setting
+from .Settings import Settings
+from .Cache import state_dir, load_json, store_json, digest_files
+from . import FlameGraph
+from . import Wheel
 from os import execvp, chdir
 
 
 @plugin
 class PythonPoetryPlugin(BasePlugin):
+    def settings(self, current_settings) -> typing.List[Setting]:
+        """returns the cache directory poetry is run with, empty for poetry's own"""
+        make_setting = self.get_settings_factory(priority=Setting.LOW)
+        return [
+            make_setting("poetry_cache_dir", os.environ.get("POETRY_CACHE_DIR", ""))
+        ]
+
+    @staticmethod
+    def _poetry_env(settings):
+        """returns the environment poetry is run with"""
+        env = dict(os.environ)
+        cache_dir = settings.get("poetry_cache_dir")
+        if cache_dir is not None and cache_dir.value:
+            env["POETRY_CACHE_DIR"] = str(cache_dir.value)
+        return env
+
+    def sync(self, settings):
+        """runs poetry install when pyproject.toml or poetry.lock changed since the
+        last sync and returns the path of the project's virtual environment"""
+        repo_base = settings["repo_base"].value
+        stamp_path = state_dir(settings) / "poetry_env.json"
+        stamp = load_json(stamp_path, {})
+        digest = digest_files([repo_base / "pyproject.toml", repo_base / "poetry.lock"])
+        if (
+            stamp.get("digest") == digest
+            and (Path(stamp["venv"]) / "bin" / "python").exists()
+        ):
+            return Path(stamp["venv"])
+
+        env = self._poetry_env(settings)
+        if run(["poetry", "install"], cwd=repo_base, env=env).returncode != 0:
+            return None
+        venv = run(
+            ["poetry", "env", "info", "--path"],
+            cwd=repo_base,
+            env=env,
+            stdout=PIPE,
+            universal_newlines=True,
+        ).stdout.strip()
+        if not venv:
+            return None
+        # hash after installing since poetry install may have written poetry.lock
+        digest = digest_files([repo_base / "pyproject.toml", repo_base / "poetry.lock"])
+        store_json(stamp_path, {"digest": digest, "venv": venv})
+        return Path(venv)
+
+    def tool(self, settings, name, venv=None):
+        """returns the command to run a tool installed in the project's environment,
+        falling back to poetry run if the environment could not be synced or does not
+        contain the tool; pass the result of sync as venv to avoid syncing again"""
+        if venv is None:
+            venv = self.sync(settings)
+        if venv is None or not (venv / "bin" / name).exists():
+            return ["poetry", "run", name]
+        return [str(venv / "bin" / name)]
+
     def build(self, settings):
         """compiles the source code or a subset thereof"""
         return run(
@@ -15,72 +79,156 @@ class PythonPoetryPlugin(BasePlugin):
     def test(self, settings):
         """runs automated tests on source code or a subset there of"""
         return run(
-            ["poetry", "run", "pytest", *settings["cmdline_test"].value],
+            [*self.tool(settings, "pytest"), *settings["cmdline_test"].value],
             cwd=settings["repo_base"].value,
         ).returncode
 
     def format(self, settings):
         """runs fomatting on source code or a subset there of"""
         return run(
-            ["poetry", "run", "black", *settings["cmdline_format"].value],
+            [*self.tool(settings, "black"), *settings["cmdline_format"].value],
             cwd=settings["repo_base"].value,
         ).returncode
 
     def tidy(self, settings):
-        """runs checks on source code or a subset there of"""
+        """runs checks on source code or a subset there of
+
+        poetry check, mypy (through its daemon) and pycodestyle run concurrently;
+        pycodestyle only checks files that changed since their cached result
+        """
         repo_base = settings["repo_base"].value
         package_dir = repo_base / repo_base.name
-        c = run(["poetry", "check"], cwd=repo_base)
-        m = run(
-            ["poetry", "run", "mypy", package_dir, *settings["cmdline_tidy"].value],
-            cwd=repo_base,
+        extra = settings["cmdline_tidy"].value
+
+        cache_path = state_dir(settings) / "pycodestyle.json"
+        config = digest_files(
+            [repo_base / name for name in ("setup.cfg", "tox.ini", ".pycodestyle")],
+            extra=extra,
         )
-        s = run(
+        cache = load_json(cache_path, {})
+        if cache.get("config") != config:
+            cache = {"config": config, "results": {}}
+        sources = {
+            str(path): digest_files([path]) for path in package_dir.rglob("*.py")
+        }
+        changed = [
+            path
+            for path, digest in sources.items()
+            if cache["results"].get(path, {}).get("digest") != digest
+        ]
+
+        venv = self.sync(settings)
+        commands = [
+            ("check", ["poetry", "check"]),
+            (
+                "mypy",
+                [
+                    *self.tool(settings, "dmypy", venv),
+                    "run",
+                    "--",
+                    str(package_dir),
+                    *extra,
+                ],
+            ),
+        ]
+        if changed:
+            commands.append(
+                (
+                    "pycodestyle",
+                    [*self.tool(settings, "pycodestyle", venv), *changed, *extra],
+                )
+            )
+        findings = 0
+        for path in sources.keys() - set(changed):
+            for line in cache["results"][path]["output"]:
+                print("[pycodestyle]", line)
+                findings += 1
+
+        returncodes, outputs = self._run_prefixed(commands, repo_base)
+        # pycodestyle exits with 1 when it has findings and something else on failure
+        if changed and returncodes[-1] in (0, 1):
+            by_file = {path: [] for path in changed}
+            for line in outputs["pycodestyle"]:
+                path = line.split(":", 1)[0]
+                if path in by_file:
+                    by_file[path].append(line)
+            for path, lines in by_file.items():
+                cache["results"][path] = {"digest": sources[path], "output": lines}
+            cache["results"] = {
+                path: result
+                for path, result in cache["results"].items()
+                if path in sources
+            }
+            store_json(cache_path, cache)
+        return next((r for r in returncodes if r), 1 if findings else 0)
+
+    @staticmethod
+    def _run_prefixed(commands, cwd):
+        """runs commands concurrently, printing each line prefixed with the command's
+        name as it arrives; returns the return codes and the output of each command"""
+        outputs = {name: [] for name, _ in commands}
+
+        def forward(name):
+            def on_line(line):
+                outputs[name].append(line)
+                print(f"[{name}]", line, flush=True)
+
+            return on_line
+
+        results = run_all(
             [
-                "poetry",
-                "run",
-                "pycodestyle",
-                package_dir,
-                *settings["cmdline_tidy"].value,
+                partial(
+                    run_async,
+                    args,
+                    cwd=cwd,
+                    stdin=DEVNULL,
+                    stdout=PIPE,
+                    stderr=STDOUT,
+                    on_line=forward(name),
+                )
+                for name, args in commands
             ],
-            cwd=repo_base,
+            jobs=len(commands),
         )
-        return c or m or s
+        return [result.returncode for result in results], outputs
 
     def install(self, settings):
         """cleans source code or a subset there of"""
-        return run(
-            [
-                "python",
-                "-m",
-                "pip",
-                "install",
-                "--user",
-                ".",
-                *settings["cmdline_install"].value,
-            ],
-            cwd=settings["repo_base"].value,
-        ).returncode
+        return Wheel.install_wheel(
+            settings, extra=["--user", *settings["cmdline_install"].value]
+        )
 
     def generate(self, settings):
         repo_base = settings["repo_base"].value
         return run(["poetry", "new", "."], cwd=repo_base).returncode
 
+    def profile(self, settings):
+        """runs a script, module or command given with -c, or the tests, under
+        py-spy in the project's environment"""
+        command = FlameGraph.python_command(
+            settings["cmdline_profile"].value, self.tool(settings, "python")
+        )
+        return FlameGraph.profile(
+            settings, command, settings["repo_base"].value, python=True
+        )
+
     def repl(self, settings):
+        args = self.tool(settings, "python")
         chdir(settings["repo_base"].value)
-        args = ["poetry", "run", "python"]
         execvp(args[0], args)
 
     @staticmethod
-    def should_enable(settings):
-        def contains(path, contents):
-            with open(path) as f:
-                return contents in f.read()
+    def _is_poetry(repo_base):
+        pyproject = repo_base / "pyproject.toml"
+        if not pyproject.exists():
+            return False
+        with open(pyproject) as f:
+            return "poetry" in f.read()
 
-        if (
-            "repo_base" in settings
-            and (settings["repo_base"].value / "pyproject.toml").exists()
-            and contains((settings["repo_base"].value / "pyproject.toml"), "poetry")
+    @staticmethod
+    def should_enable(settings):
+        if "repo_base" in settings and PythonPoetryPlugin._is_poetry(
+            settings["repo_base"].value
         ):
             state = PluginSupport.DEFAULT_MAIN
         else:
@@ -91,8 +239,13 @@ class PythonPoetryPlugin(BasePlugin):
     def _supported(settings):
         """returns a dictionary of supported functions"""
         state = PythonPoetryPlugin.should_enable(settings)
+        if PythonPoetryPlugin._is_poetry(Settings.find_repo_base()):
+            settings_state = PluginSupport.DEFAULT_AFTER_MAIN
+        else:
+            settings_state = PluginSupport.NOT_ENABLED_BY_REPOSITORY
 
         return {
+            "settings": settings_state,
             "build": state,
             "test": state,
             "repl": state,
@@ -101,4 +254,5 @@ class PythonPoetryPlugin(BasePlugin):
             "format": state,
             "repl": state,
             "generate": state,
+            "profile": state,
         }
@@ -0,0 +1,442 @@
+"""launches child processes like subprocess while recording the resources each child
+used, as reported by wait4, and keeps a history of what every m action consumed
+
+children run on an asyncio event loop: their pipes are read as data arrives instead
+of by a thread per pipe, several can run at once with run_all, and a child that times
+out or whose caller is cancelled or interrupted is stopped together with everything
+it started.
+"""
+
+import asyncio
+import json
+import locale
+import os
+import signal
+import subprocess
+import threading
+import time
+from subprocess import (  # noqa: F401 re-exported so plugins only import from here
+    PIPE,
+    STDOUT,
+    DEVNULL,
+    CalledProcessError,
+    CompletedProcess,
+    TimeoutExpired,
+)
+from .Paths import user_cache_dir
+
+MAX_ENTRIES = 20000
+CHUNK = 65536
+# seconds a child gets to exit after each signal before the next, stronger one
+GRACE = 3
+# usage of every child reaped since m started, in the order they exited
+USAGE = []
+_LOCK = threading.Lock()
+
+
+def _program(args):
+    if isinstance(args, (str, bytes)):
+        args = args.split()
+    program = os.fsdecode(args[0]) if args else ""
+    return program.rsplit("/", 1)[-1]
+
+
+class Popen(subprocess.Popen):
+    """subprocess.Popen whose poll and wait reap the child with wait4 to record its
+    rusage; the rusage also covers the descendants that the child waited for itself"""
+
+    def __init__(self, args, *pargs, **kwargs):
+        self._started = time.monotonic()
+        super().__init__(args, *pargs, **kwargs)
+
+    def _reap(self, flags):
+        """reaps the child with wait4 if it exited, returning its returncode or None
+        if it is still running"""
+        if self.returncode is not None:
+            return self.returncode
+        try:
+            pid, status, rusage = os.wait4(self.pid, flags)
+        except ChildProcessError:
+            # like subprocess, treat a child that was reaped elsewhere as a success
+            self.returncode = 0
+            return self.returncode
+        if pid == 0:
+            return None
+        self.returncode = os.waitstatus_to_exitcode(status)
+        with _LOCK:
+            USAGE.append(
+                {
+                    "program": _program(self.args),
+                    "wall": time.monotonic() - self._started,
+                    "utime": rusage.ru_utime,
+                    "stime": rusage.ru_stime,
+                    "maxrss": rusage.ru_maxrss,
+                    "inblock": rusage.ru_inblock,
+                    "oublock": rusage.ru_oublock,
+                    "nvcsw": rusage.ru_nvcsw,
+                    "nivcsw": rusage.ru_nivcsw,
+                }
+            )
+        return self.returncode
+
+    def poll(self):
+        return self._reap(os.WNOHANG)
+
+    def wait(self, timeout=None):
+        if timeout is None:
+            return self._reap(0)
+        deadline = time.monotonic() + timeout
+        delay = 0.0005
+        while self._reap(os.WNOHANG) is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutExpired(self.args, timeout)
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.05)
+        return self.returncode
+
+
+class _Output:
+    """collects what a child writes to one pipe, or hands each complete line to
+    on_line as it arrives"""
+
+    def __init__(self, on_line):
+        self.on_line = on_line
+        self.chunks = []
+        self.partial = b""
+
+    def feed(self, chunk):
+        if self.on_line is None:
+            self.chunks.append(chunk)
+            return
+        *lines, self.partial = (self.partial + chunk).split(b"\n")
+        for line in lines:
+            self.on_line(line.rstrip(b"\r").decode(errors="replace"))
+
+    def close(self):
+        if self.partial:
+            self.on_line(self.partial.rstrip(b"\r").decode(errors="replace"))
+            self.partial = b""
+
+    def data(self):
+        return b"".join(self.chunks) if self.on_line is None else None
+
+
+def _decode(data, text, encoding, errors):
+    """decodes output like subprocess does in text mode"""
+    if data is None or not text:
+        return data
+    data = data.decode(
+        encoding or locale.getpreferredencoding(False), errors or "strict"
+    )
+    return data.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def _read(loop, stream, sink):
+    """returns a future that is done once stream reached end of file, passing every
+    chunk read from it to sink"""
+    done = loop.create_future()
+    fd = stream.fileno()
+    os.set_blocking(fd, False)
+
+    def readable():
+        try:
+            chunk = os.read(fd, CHUNK)
+        except BlockingIOError:
+            return
+        except OSError:
+            chunk = b""
+        if chunk:
+            sink(chunk)
+            return
+        loop.remove_reader(fd)
+        if not done.done():
+            done.set_result(None)
+
+    loop.add_reader(fd, readable)
+    return done
+
+
+def _write(loop, stream, data):
+    """returns a future that is done once data was written to stream and it was
+    closed; like communicate, a child that exits without reading it all is fine"""
+    done = loop.create_future()
+    fd = stream.fileno()
+    os.set_blocking(fd, False)
+    view = memoryview(data)
+
+    def writable():
+        nonlocal view
+        try:
+            view = view[os.write(fd, view[:CHUNK]) :]
+        except BlockingIOError:
+            return
+        except (BrokenPipeError, ConnectionResetError):
+            view = view[:0]
+        if not view:
+            loop.remove_writer(fd)
+            stream.close()
+            if not done.done():
+                done.set_result(None)
+
+    if view:
+        loop.add_writer(fd, writable)
+    else:
+        stream.close()
+        done.set_result(None)
+    return done
+
+
+async def _wait(proc):
+    """waits for proc to exit without blocking the loop and reaps it"""
+    loop = asyncio.get_running_loop()
+    try:
+        pidfd = os.pidfd_open(proc.pid)
+    except (AttributeError, OSError):
+        pidfd = None
+    if pidfd is None:
+        delay = 0.001
+        while proc.poll() is None:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.05)
+        return proc.returncode
+    exited = loop.create_future()
+    loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+    try:
+        await exited
+    finally:
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+    return proc.wait()
+
+
+def _signal(proc, sig, group):
+    """sends sig to the process group of proc, or only to proc if it shares m's"""
+    try:
+        if group:
+            os.killpg(proc.pid, sig)
+        elif proc.returncode is None:
+            proc.send_signal(sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+async def _stop(proc, group, signals):
+    """sends each of signals in turn until proc exits, waiting GRACE seconds after
+    each; None waits without sending anything"""
+    for sig in signals:
+        if sig is not None:
+            _signal(proc, sig, group)
+        try:
+            await asyncio.wait_for(_wait(proc), GRACE)
+            break
+        except asyncio.TimeoutError:
+            continue
+    if group:
+        # the leader is gone, do not leave the rest of its process group behind
+        _signal(proc, signal.SIGKILL, group)
+
+
+def _own_group(kwargs):
+    """children get their own session, and with it their own process group, so that
+    all they started can be stopped at once; a child that reads from m's terminal
+    stays in m's session and foreground group so that it can, which also means the
+    terminal sends it Ctrl-C itself"""
+    if kwargs.get("stdin") is not None:
+        return True
+    try:
+        return not os.isatty(0)
+    except OSError:
+        return True
+
+
+async def run_async(
+    args, *, input=None, timeout=None, check=False, on_line=None, **kwargs
+):
+    """runs args like subprocess.run without blocking the event loop
+
+    with on_line every line the child writes to a pipe is passed to on_line, without
+    its line ending, as soon as it arrives instead of being collected, and stdout
+    defaults to a pipe.  on a timeout the child's process group is sent SIGTERM and
+    then SIGKILL, and TimeoutExpired is raised.  if the caller is cancelled, which is
+    what Ctrl-C does to run and run_all, the group is sent SIGINT, SIGTERM and
+    SIGKILL in turn until it exits.
+    """
+    if kwargs.pop("capture_output", False):
+        kwargs["stdout"] = PIPE
+        kwargs["stderr"] = PIPE
+    if on_line is not None:
+        kwargs.setdefault("stdout", PIPE)
+    if input is not None:
+        kwargs["stdin"] = PIPE
+    encoding = kwargs.pop("encoding", None)
+    errors = kwargs.pop("errors", None)
+    text = bool(
+        kwargs.pop("universal_newlines", None)
+        or kwargs.pop("text", None)
+        or encoding
+        or errors
+    )
+    if isinstance(input, str):
+        input = input.encode(encoding or locale.getpreferredencoding(False))
+    group = _own_group(kwargs)
+    if group:
+        kwargs.setdefault("start_new_session", True)
+
+    loop = asyncio.get_running_loop()
+    proc = Popen(args, bufsize=0, **kwargs)
+    outputs = {}
+    pending = []
+    try:
+        for name in ("stdout", "stderr"):
+            stream = getattr(proc, name)
+            if stream is not None:
+                outputs[name] = _Output(on_line)
+                pending.append(_read(loop, stream, outputs[name].feed))
+        if proc.stdin is not None:
+            pending.append(_write(loop, proc.stdin, input or b""))
+
+        async def communicate():
+            await asyncio.gather(*pending)
+            return await _wait(proc)
+
+        try:
+            returncode = await asyncio.wait_for(communicate(), timeout)
+        except asyncio.TimeoutError:
+            await _stop(proc, group, (signal.SIGTERM, signal.SIGKILL))
+            raise TimeoutExpired(
+                proc.args,
+                timeout,
+                output=outputs["stdout"].data() if "stdout" in outputs else None,
+                stderr=outputs["stderr"].data() if "stderr" in outputs else None,
+            ) from None
+        except asyncio.CancelledError:
+            # a child that shares m's group already got the Ctrl-C from the terminal
+            first = signal.SIGINT if group else None
+            await _stop(proc, group, (first, signal.SIGTERM, signal.SIGKILL))
+            raise
+    finally:
+        for future in pending:
+            future.cancel()
+        for stream in (proc.stdin, proc.stdout, proc.stderr):
+            if stream is not None and not stream.closed:
+                loop.remove_reader(stream.fileno())
+                loop.remove_writer(stream.fileno())
+                stream.close()
+        if proc.returncode is None:
+            # cancelled again while stopping the child, which must not outlive m
+            _signal(proc, signal.SIGKILL, group)
+            proc.wait()
+    for output in outputs.values():
+        if output.on_line is not None:
+            output.close()
+
+    stdout, stderr = (
+        (
+            _decode(outputs[name].data(), text, encoding, errors)
+            if name in outputs
+            else None
+        )
+        for name in ("stdout", "stderr")
+    )
+    if check and returncode:
+        raise CalledProcessError(returncode, proc.args, output=stdout, stderr=stderr)
+    return CompletedProcess(proc.args, returncode, stdout, stderr)
+
+
+def run(*popenargs, **kwargs):
+    """subprocess.run on top of run_async, see there for on_line and for how the
+    child is stopped on a timeout or Ctrl-C"""
+    return asyncio.run(run_async(*popenargs, **kwargs))
+
+
+async def gather(steps, jobs=None):
+    """awaits steps, functions returning an awaitable such as a functools.partial of
+    run_async, with at most jobs of them running at once and returns their results
+    in order; once one raises, the others are cancelled"""
+    semaphore = asyncio.Semaphore(jobs or os.cpu_count() or 1)
+
+    async def limited(step):
+        async with semaphore:
+            return await step()
+
+    tasks = [asyncio.ensure_future(limited(step)) for step in steps]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def run_all(steps, jobs=None):
+    """runs gather on its own event loop"""
+    return asyncio.run(gather(steps, jobs))
+
+
+def mark():
+    """returns a marker for usage_since"""
+    return len(USAGE)
+
+
+def usage_since(marker):
+    """returns the summed usage of the children reaped since marker"""
+    with _LOCK:
+        children = USAGE[marker:]
+    total = {
+        key: sum(child[key] for child in children)
+        for key in ("utime", "stime", "inblock", "oublock", "nvcsw", "nivcsw")
+    }
+    total["maxrss"] = max((child["maxrss"] for child in children), default=0)
+    total["children"] = len(children)
+    return total
+
+
+def history_path():
+    return user_cache_dir() / "stats.jsonl"
+
+
+def record_action(settings, mode, wall, usage, returncode):
+    """appends the resources one m action used to the shared history"""
+    entry = {
+        "t": round(time.time()),
+        "repo": str(settings["repo_base"].value),
+        "build_dir": str(settings["build_dir"].value),
+        "mode": mode,
+        "rc": returncode,
+        "wall": round(wall, 3),
+        **{
+            key: round(value, 3) if isinstance(value, float) else value
+            for key, value in usage.items()
+        },
+    }
+    path = history_path()
+    with open(path, "a") as outfile:
+        outfile.write(json.dumps(entry, separators=(",", ":")) + "\n")
+    if path.stat().st_size > MAX_ENTRIES * 300:
+        _truncate(path)
+
+
+def _truncate(path):
+    """keeps the newest half of the history"""
+    lines = path.read_text().splitlines(keepends=True)
+    if len(lines) <= MAX_ENTRIES:
+        return
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text("".join(lines[-MAX_ENTRIES // 2 :]))
+    os.replace(tmp, path)
+
+
+def load_history():
+    """returns the recorded actions, skipping lines that were cut off"""
+    entries = []
+    try:
+        with open(history_path()) as infile:
+            for line in infile:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+    except OSError:
+        pass
+    return entries
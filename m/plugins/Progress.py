@@ -0,0 +1,173 @@
+"""predicts the remaining time of a build from the durations of previous builds"""
+
+import logging
+import math
+import os
+import re
+import statistics
+import sys
+import time
+from .Process import run, PIPE, STDOUT
+from . import BuildLog
+from .Cache import state_dir, load_json, store_json
+
+LOGGER = logging.getLogger(__name__)
+
+NINJA_STATUS = re.compile(r"^\[(\d+)/(\d+)\] (.*)$")
+MAKE_PERCENT = re.compile(r"^\[\s*(\d+)%\]")
+UPDATE_INTERVAL = 0.5
+CHECKPOINTS = (0.25, 0.5, 0.75)
+MAX_ERRORS = 50
+ALPHA = 0.3
+
+
+def _format_eta(seconds):
+    seconds = max(0, round(seconds))
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class EtaEstimator:
+    """estimates the time remaining in a build
+
+    ninja builds are weighted by the historical duration of each target that has not
+    finished yet, divided by the parallelism achieved in previous builds.  make builds
+    have no per-target information, so they are extrapolated from the percentage cmake
+    prints or from the number of lines previous builds printed.
+    """
+
+    def __init__(self, settings, kind):
+        self.kind = kind
+        self.started = time.monotonic()
+        self.state_path = state_dir(settings) / "eta.json"
+        self.state = load_json(self.state_path, {"correction": 1.0, "errors": []})
+        self.make_path = state_dir(settings) / "make_history.json"
+        self.make_history = load_json(self.make_path, [])
+        self.lines = 0
+        self.fraction = None
+        self.remaining_edges = None
+        self.checkpoints = []
+
+        self.expected = {}
+        self.parallelism = settings["jobs"].value
+        if kind == "ninja":
+            history = BuildLog.update_ninja_history(settings)
+            self.expected = {
+                name: total / count
+                for name, (count, total) in history["totals"].items()
+            }
+            if history["builds"]:
+                last = BuildLog.summarize(history["builds"][-1], [], {})
+                self.parallelism = max(1, min(self.parallelism, last["parallelism"]))
+        self.unfinished_ms = sum(self.expected.values())
+        self.unfinished_count = len(self.expected)
+
+    def observe(self, line):
+        """updates the progress from a line of build output"""
+        self.lines += 1
+        status = NINJA_STATUS.match(line)
+        if status:
+            finished, total = int(status.group(1)), int(status.group(2))
+            self.fraction = finished / total
+            self.remaining_edges = total - finished
+            target = status.group(3).rsplit(" ", 1)[-1]
+            expected = self.expected.pop(target, None)
+            if expected is not None:
+                self.unfinished_ms -= expected
+                self.unfinished_count -= 1
+        else:
+            percent = MAKE_PERCENT.match(line)
+            if percent:
+                self.fraction = int(percent.group(1)) / 100
+        self._checkpoint()
+
+    def _checkpoint(self):
+        """remembers the predicted total duration as the build passes each checkpoint"""
+        checkpoint = len(self.checkpoints)
+        if checkpoint == len(CHECKPOINTS):
+            return
+        elapsed = time.monotonic() - self.started
+        raw, fraction = self._raw_remaining(elapsed)
+        if raw is not None and fraction >= CHECKPOINTS[checkpoint]:
+            self.checkpoints.append(elapsed + raw)
+
+    def _raw_remaining(self, elapsed):
+        """returns the seconds remaining before applying the learned correction and
+        the fraction of the build that is done"""
+        fraction = self.fraction
+        if fraction is None and self.make_history:
+            expected_lines = statistics.median(b["lines"] for b in self.make_history)
+            fraction = min(self.lines / max(expected_lines, 1), 0.99)
+        if self.remaining_edges is not None and self.unfinished_count > 0:
+            mean = self.unfinished_ms / self.unfinished_count / 1000
+            return self.remaining_edges * mean / self.parallelism, fraction
+        if not fraction:
+            return None, fraction
+        return elapsed * (1 - fraction) / fraction, fraction
+
+    def remaining(self):
+        """returns the estimated seconds remaining, or None if there is no estimate"""
+        elapsed = time.monotonic() - self.started
+        raw, _ = self._raw_remaining(elapsed)
+        if raw is None:
+            return None
+        return raw * self.state["correction"]
+
+    def finish(self, returncode):
+        """records how far off the predictions were so later estimates improve"""
+        if returncode != 0:
+            return
+        actual = time.monotonic() - self.started
+        if self.kind == "make":
+            self.make_history.append({"lines": self.lines, "ms": round(actual * 1000)})
+            store_json(self.make_path, self.make_history[-MAX_ERRORS:])
+        for predicted in self.checkpoints:
+            if predicted <= 0:
+                continue
+            ratio = min(4.0, max(0.25, actual / predicted))
+            self.state["correction"] = math.exp(
+                (1 - ALPHA) * math.log(self.state["correction"])
+                + ALPHA * math.log(ratio)
+            )
+            self.state["errors"].append(
+                {"predicted": round(predicted, 2), "actual": round(actual, 2)}
+            )
+        del self.state["errors"][:-MAX_ERRORS]
+        store_json(self.state_path, self.state)
+
+
+def run_with_eta(args, settings, kind, **kwargs):
+    """runs a build, echoing its output and showing the estimated time remaining"""
+    if not settings["eta"].value or not sys.stderr.isatty():
+        return run(args, **kwargs).returncode
+
+    env = dict(kwargs.pop("env", None) or os.environ)
+    env.setdefault("CLICOLOR_FORCE", "1")
+    estimator = EtaEstimator(settings, kind)
+    status = ""
+    last_update = 0.0
+
+    def forward(line):
+        nonlocal status, last_update
+        estimator.observe(line)
+        sys.stderr.write("\r\x1b[K")
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+        now = time.monotonic()
+        if now - last_update > UPDATE_INTERVAL:
+            last_update = now
+            remaining = estimator.remaining()
+            if remaining is not None:
+                status = f"m: ~{_format_eta(remaining)} remaining"
+        sys.stderr.write(status)
+        sys.stderr.flush()
+
+    try:
+        returncode = run(
+            args, stdout=PIPE, stderr=STDOUT, env=env, on_line=forward, **kwargs
+        ).returncode
+    finally:
+        sys.stderr.write("\r\x1b[K")
+    estimator.finish(returncode)
+    return returncode
@@ -0,0 +1,121 @@
+"""runs pytest across a pool of processes ordered by the history of previous runs"""
+
+import logging
+import xml.etree.ElementTree as ET
+from functools import partial
+from .Process import run, run_all, run_async, DEVNULL, STDOUT
+from .Cache import state_dir, load_json, store_json, source_files, source_digest
+
+LOGGER = logging.getLogger(__name__)
+
+SOURCES = ("*.py", "setup.cfg", "pyproject.toml", "pytest.ini", "tox.ini")
+NO_TESTS_COLLECTED = 5
+
+
+def _is_test_file(path):
+    return path.name.startswith("test_") or path.name.endswith("_test.py")
+
+
+def partition(files, durations, failed, workers):
+    """orders files failed first then slowest first, and greedily assigns each file
+    to the least loaded worker; files without history are treated as the slowest"""
+    slowest = max(durations.values(), default=1.0)
+    order = sorted(
+        files,
+        key=lambda f: (f not in failed, -durations.get(f, slowest)),
+    )
+    loads = [[0.0, []] for _ in range(workers)]
+    for name in order:
+        lightest = min(loads, key=lambda load: load[0])
+        lightest[0] += durations.get(name, slowest)
+        lightest[1].append(name)
+    return [files for _, files in loads if files]
+
+
+def _read_report(report):
+    """returns the time spent in and the failure status of each file in a junit report"""
+    durations = {}
+    failed = set()
+    try:
+        root = ET.parse(report).getroot()
+    except (OSError, ET.ParseError):
+        return durations, failed
+    for case in root.iter("testcase"):
+        name = case.get("file")
+        if name is None:
+            continue
+        durations[name] = durations.get(name, 0.0) + float(case.get("time", 0))
+        if case.find("failure") is not None or case.find("error") is not None:
+            failed.add(name)
+    return durations, failed
+
+
+def run_tests(settings, python=("python",)):
+    """runs the project's tests with pytest across up to jobs worker processes"""
+    repo_base = settings["repo_base"].value
+    args = settings["cmdline_test"].value
+    history_path = state_dir(settings) / "pytest.json"
+    history = load_json(history_path, {"green": None, "durations": {}, "failed": []})
+
+    digest = source_digest(repo_base, *SOURCES)
+    if not args and history["green"] == digest:
+        print("m: no python sources changed since the last passing test run")
+        return 0
+
+    files = sorted(
+        str(path.relative_to(repo_base))
+        for path in source_files(repo_base, "*.py")
+        if _is_test_file(path)
+    )
+    if args or not files:
+        return run([*python, "-m", "pytest", *args], cwd=repo_base).returncode
+
+    workers = min(settings["jobs"].value, len(files))
+    groups = partition(files, history["durations"], set(history["failed"]), workers)
+    report_dir = state_dir(settings, "pytest")
+
+    async def run_group(index):
+        report = report_dir / f"worker-{index}.xml"
+        report.unlink(missing_ok=True)
+        result = await run_async(
+            [
+                *python,
+                "-m",
+                "pytest",
+                "-p",
+                "no:cacheprovider",
+                "-o",
+                "junit_family=xunit1",
+                f"--junitxml={report}",
+                *groups[index],
+            ],
+            cwd=repo_base,
+            stdin=DEVNULL,
+            stderr=STDOUT,
+            on_line=lambda line: print(f"[{index}]", line, flush=True),
+        )
+        return result, report
+
+    LOGGER.info("running %d test files on %d workers", len(files), len(groups))
+    returncode = 0
+    failed = set()
+    results = run_all(
+        [partial(run_group, index) for index in range(len(groups))], len(groups)
+    )
+    for index, (result, report) in enumerate(results):
+        if result.returncode not in (0, NO_TESTS_COLLECTED):
+            returncode = returncode or result.returncode
+        durations, group_failed = _read_report(report)
+        history["durations"].update(durations)
+        failed |= group_failed
+        if result.returncode not in (0, NO_TESTS_COLLECTED) and not group_failed:
+            # the worker failed before writing its report, rerun its files first
+            failed.update(groups[index])
+
+    history["failed"] = sorted(failed)
+    history["durations"] = {
+        name: time for name, time in history["durations"].items() if name in files
+    }
+    history["green"] = digest if returncode == 0 else None
+    store_json(history_path, history)
+    return returncode
@@ -1,5 +1,8 @@
-from subprocess import run
+from .Process import run
 from .Base import plugin, BasePlugin, PluginSupport
+from . import FlameGraph
+from . import PyTest
+from . import Wheel
 from os import execvp, chdir
 
 
@@ -7,17 +10,15 @@ from os import execvp, chdir
 class PythonSetupToolsPlugin(BasePlugin):
     def build(self, settings):
         """compiles the source code or a subset thereof"""
-        return run(
-            ["python", "setup.py", "build", *settings["cmdline_build"].value],
-            cwd=settings["repo_base"].value,
-        ).returncode
+        wheel = Wheel.build_wheel(settings, extra=settings["cmdline_build"].value)
+        if wheel is None:
+            return 1
+        print("m: built", wheel)
+        return 0
 
     def test(self, settings):
         """runs automated tests on source code or a subset there of"""
-        return run(
-            ["python", "setup.py", "test", *settings["cmdline_test"].value],
-            cwd=settings["repo_base"].value,
-        ).returncode
+        return PyTest.run_tests(settings)
 
     def clean(self, settings):
         """cleans source code or a subset there of"""
@@ -28,10 +29,17 @@ class PythonSetupToolsPlugin(BasePlugin):
 
     def install(self, settings):
         """cleans source code or a subset there of"""
-        return run(
-            ["python", "setup.py", "install", *settings["cmdline_install"].value],
-            cwd=settings["repo_base"].value,
-        ).returncode
+        return Wheel.install_wheel(settings, extra=settings["cmdline_install"].value)
+
+    def profile(self, settings):
+        """runs a script, module or command given with -c, or the tests, under
+        py-spy"""
+        command = FlameGraph.python_command(
+            settings["cmdline_profile"].value, ["python"]
+        )
+        return FlameGraph.profile(
+            settings, command, settings["repo_base"].value, python=True
+        )
 
     def repl(self, settings):
         chdir(settings["repo_base"].value)
@@ -56,4 +64,5 @@ class PythonSetupToolsPlugin(BasePlugin):
             "repl": state,
             "install": state,
             "repl": state,
+            "profile": state,
         }
@@ -1,21 +1,193 @@
-from subprocess import run
-from .Base import plugin, BasePlugin, PluginSupport
+import logging
+import os
+import shutil
+import typing
+from pathlib import Path
+from .Process import run, PIPE
+from .Base import plugin, BasePlugin, PluginSupport, Setting
+from .Settings import Settings
+from .Cache import state_dir
+from . import BuildLog, CargoTest, FlameGraph, Pgo
+
+try:
+    import tomllib
+except ImportError:  # python < 3.11
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+LOGGER = logging.getLogger(__name__)
+
+LINKERS = {"mold": "mold", "lld": "ld.lld"}
+RELEASE_PROFILE = {"lto": "thin", "incremental": "true", "codegen-units": "16"}
+LINKER_SCRIPT = '#!/bin/sh\nexec "${{CC:-cc}}" -fuse-ld={linker} "$@"\n'
+
+
+def _cargo_configs(repo_base):
+    """returns the cargo configuration files that apply to builds in repo_base"""
+    cargo_home = Path(os.environ.get("CARGO_HOME", Path.home() / ".cargo"))
+    directories = [repo_base / ".cargo", *(p / ".cargo" for p in repo_base.parents)]
+    return [
+        directory / name
+        for directory in [*directories, cargo_home]
+        for name in ("config", "config.toml")
+        if (directory / name).is_file()
+    ]
+
+
+def _user_configured(repo_base, env_names, keys):
+    """returns if the user already configured one of env_names or keys"""
+    if any(name in os.environ for name in env_names):
+        return True
+    rustflags = " ".join(
+        os.environ.get(name, "") for name in ("RUSTFLAGS", "CARGO_ENCODED_RUSTFLAGS")
+    )
+    if any(key in rustflags for key in keys):
+        return True
+    return any(
+        key in path.read_text(errors="replace")
+        for path in _cargo_configs(repo_base)
+        for key in keys
+    )
+
+
+def _host_triple():
+    result = run(["rustc", "-vV"], stdout=PIPE, universal_newlines=True)
+    for line in result.stdout.splitlines():
+        if line.startswith("host:"):
+            return line.split(":", 1)[1].strip()
+    return None
+
+
+def cargo_env(settings):
+    """returns the environment for cargo with the compiler cache and linker from the
+    rustc_wrapper and rust_linker settings
+
+    the linker is selected through CARGO_TARGET_<host>_LINKER and a wrapper script
+    at a fixed path rather than through RUSTFLAGS, because cargo fingerprints
+    RUSTFLAGS and alternating between m and a bare cargo would rebuild every crate.
+    """
+    env = dict(os.environ)
+    repo_base = settings["repo_base"].value
+    wrapper = settings.get("rustc_wrapper")
+    if (
+        wrapper
+        and wrapper.value
+        and not _user_configured(
+            repo_base,
+            ("RUSTC_WRAPPER", "CARGO_BUILD_RUSTC_WRAPPER"),
+            ("rustc-wrapper",),
+        )
+    ):
+        env["RUSTC_WRAPPER"] = wrapper.value
+
+    linker = settings.get("rust_linker")
+    host = _host_triple() if linker and linker.value else None
+    if host is not None:
+        variable = "CARGO_TARGET_{}_LINKER".format(
+            host.upper().replace("-", "_").replace(".", "_")
+        )
+        if not _user_configured(repo_base, (variable,), ("linker", "fuse-ld")):
+            script = state_dir(settings) / f"rust-linker-{linker.value}"
+            contents = LINKER_SCRIPT.format(linker=linker.value)
+            # rewriting the script would change its mtime, so only write it once
+            if not script.exists() or script.read_text() != contents:
+                script.write_text(contents)
+                script.chmod(0o755)
+            env[variable] = str(script)
+    if settings.get("release") and settings["release"].value:
+        release_env(settings, env)
+    return env
+
+
+def _release_profile(repo_base):
+    """returns the [profile.release] table of the workspace's Cargo.toml"""
+    try:
+        with open(repo_base / "Cargo.toml", "rb") as infile:
+            return tomllib.load(infile).get("profile", {}).get("release", {})
+    except (OSError, ValueError):
+        return {}
+
+
+def release_env(settings, env):
+    """adds ThinLTO across the crate graph to the release profile of env, keeping the
+    release build incremental so that relinks reuse the cached codegen units; keys
+    that Cargo.toml or the environment already set are left alone"""
+    if tomllib is None:
+        LOGGER.warning(
+            "install tomli to read Cargo.toml, not tuning the release profile"
+        )
+        return env
+    profile = _release_profile(settings["repo_base"].value)
+    for key, value in RELEASE_PROFILE.items():
+        variable = f"CARGO_PROFILE_RELEASE_{key.upper().replace('-', '_')}"
+        if key not in profile and variable not in env:
+            env[variable] = value
+    return env
+
+
+def _llvm_profdata(settings):
+    """returns the llvm-profdata of the llvm-tools component if it is installed, since
+    the profile format has to match the llvm version of rustc; it is installed with
+    rustup component add llvm-tools"""
+    sysroot = run(["rustc", "--print", "sysroot"], stdout=PIPE, universal_newlines=True)
+    host = _host_triple()
+    if sysroot.returncode == 0 and host is not None:
+        tool = Path(sysroot.stdout.strip(), "lib", "rustlib", host, "bin")
+        if (tool / "llvm-profdata").exists():
+            return str(tool / "llvm-profdata")
+    return settings["llvm_profdata"].value
+
+
+def _detect_linker():
+    """returns the fastest linker that the system has on the path"""
+    for linker, program in LINKERS.items():
+        if shutil.which(program):
+            return linker
+    return ""
 
 
 @plugin
 class RustPlugin(BasePlugin):
+    def settings(self, current_settings) -> typing.List[Setting]:
+        """returns the compiler cache and linker that cargo is run with and how tests
+        are run"""
+        make_setting = self.get_settings_factory(priority=Setting.LOW)
+        wrapper = shutil.which("sccache") or ""
+        return [
+            make_setting("rustc_wrapper", os.environ.get("RUSTC_WRAPPER", wrapper)),
+            make_setting("rust_linker", _detect_linker()),
+            make_setting("cargo_test_runner", "m"),
+            make_setting("test_timeout", 300),
+        ]
+
+    @staticmethod
+    def profile_args(settings):
+        """returns the cargo arguments that select the profile of the build"""
+        return ["--release"] if settings["release"].value else []
+
     def build(self, settings):
         """compiles the source code or a subset thereof"""
         return run(
-            ["cargo", "build", *settings["cmdline_build"].value],
+            [
+                "cargo",
+                "build",
+                *self.profile_args(settings),
+                *settings["cmdline_build"].value,
+            ],
             cwd=settings["repo_base"].value,
+            env=cargo_env(settings),
         ).returncode
 
     def test(self, settings):
         """runs automated tests on source code or a subset there of"""
+        if settings["cargo_test_runner"].value == "m":
+            return CargoTest.run_tests(settings, cargo_env(settings))
         return run(
             ["cargo", "test", *settings["cmdline_test"].value],
             cwd=settings["repo_base"].value,
+            env=cargo_env(settings),
         ).returncode
 
     def clean(self, settings):
@@ -27,13 +199,20 @@ class RustPlugin(BasePlugin):
         return run(
             ["cargo", "install", "--path", ".", *settings["cmdline_install"].value],
             cwd=settings["repo_base"].value,
+            env=cargo_env(settings),
         ).returncode
 
     def run(self, settings):
         """runs the binary"""
         return run(
-            ["cargo", "run", *settings["cmdline_run"].value],
+            [
+                "cargo",
+                "run",
+                *self.profile_args(settings),
+                *settings["cmdline_run"].value,
+            ],
             cwd=settings["repo_base"].value,
+            env=cargo_env(settings),
         ).returncode
 
     def format(self, settings):
@@ -48,6 +227,7 @@ class RustPlugin(BasePlugin):
         return run(
             ["cargo", "check", *settings["cmdline_tidy"].value],
             cwd=settings["repo_base"].value,
+            env=cargo_env(settings),
         ).returncode
 
     def bench(self, settings):
@@ -55,8 +235,100 @@ class RustPlugin(BasePlugin):
         return run(
             ["cargo", "bench", *settings["cmdline_bench"].value],
             cwd=settings["repo_base"].value,
+            env=cargo_env(settings),
         ).returncode
 
+    def pgo(self, settings):
+        """builds an instrumented variant in its own target directory, trains it with
+        pgo_train or the benchmarks and compares a build optimized with the merged
+        profile against a release build"""
+        repo_base = settings["repo_base"].value
+        env = cargo_env(settings)
+        target_dir = BuildLog.cargo_target_dir(settings)
+        flags = {
+            "gen": "-Cprofile-generate={}",
+            "base": "",
+            "use": "-Cprofile-use={}",
+        }
+        command = Pgo.train_command(settings)
+
+        def stage_env(stage, path=None):
+            rustflags = " ".join(
+                flag
+                for flag in (env.get("RUSTFLAGS", ""), flags[stage].format(path))
+                if flag
+            )
+            return dict(
+                env,
+                RUSTFLAGS=rustflags,
+                CARGO_TARGET_DIR=str(target_dir / f"pgo-{stage}"),
+            )
+
+        # the profile path is only known when building, remember it for training
+        paths = {}
+
+        def build(stage, path):
+            paths[stage] = path
+            if command is None:
+                args = ["cargo", "bench", "--no-run"]
+            else:
+                args = ["cargo", "build", "--release"]
+            return run(
+                [*args, *settings["cmdline_pgo"].value],
+                cwd=repo_base,
+                env=stage_env(stage, path),
+            ).returncode
+
+        def train(stage):
+            if command is None:
+                args = ["cargo", "bench", *settings["cmdline_pgo"].value]
+            else:
+                # a bare binary name is the one built for this stage
+                release_dir = target_dir / f"pgo-{stage}" / "release"
+                args = FlameGraph.resolve_target(release_dir, command)
+            return run(
+                args, cwd=repo_base, env=stage_env(stage, paths.get(stage))
+            ).returncode
+
+        version = run(["rustc", "-vV"], stdout=PIPE, universal_newlines=True).stdout
+        key = Pgo.profile_key(
+            settings,
+            version,
+            *(command or ["cargo bench"]),
+            *settings["cmdline_pgo"].value,
+        )
+        return Pgo.pgo(settings, _llvm_profdata(settings), key, build, train)
+
+    def profile(self, settings):
+        """builds with frame pointers and debug info in its own target directory and
+        runs the benchmarks, or the command given with -c, under perf"""
+        repo_base = settings["repo_base"].value
+        env = cargo_env(settings)
+        rustflags = env.get("RUSTFLAGS", "")
+        target_dir = BuildLog.cargo_target_dir(settings) / "profile"
+        env.update(
+            RUSTFLAGS=f"{rustflags} -Cforce-frame-pointers=yes".strip(),
+            CARGO_PROFILE_RELEASE_DEBUG="true",
+            CARGO_PROFILE_BENCH_DEBUG="true",
+            CARGO_TARGET_DIR=str(target_dir),
+        )
+        command = settings["cmdline_profile"].value
+        if command:
+            build = ["cargo", "build", "--release"]
+        else:
+            build = ["cargo", "bench", "--no-run"]
+            command = ["cargo", "bench"]
+        # build first so that the compilation does not end up in the profile
+        returncode = run(build, cwd=repo_base, env=env).returncode
+        if returncode:
+            return returncode
+        command = FlameGraph.resolve_target(target_dir / "release", command)
+        return FlameGraph.profile(settings, command, repo_base, env=env)
+
+    def analyze(self, settings):
+        """reports where the time of the last cargo build --timings went"""
+        return BuildLog.analyze_cargo(settings, env=cargo_env(settings))
+
     def generate(self, settings):
         return run(
             ["cargo", "init", *settings["cmdline_generate"].value],
@@ -76,7 +348,13 @@ class RustPlugin(BasePlugin):
             state = PluginSupport.NOT_ENABLED_BY_REPOSITORY
             install_state = PluginSupport.NOT_ENABLED_BY_REPOSITORY
 
+        if (Settings.find_repo_base() / "Cargo.toml").exists():
+            settings_state = PluginSupport.DEFAULT_AFTER_MAIN
+        else:
+            settings_state = PluginSupport.NOT_ENABLED_BY_REPOSITORY
+
         return {
+            "settings": settings_state,
             "build": state,
             "test": state,
             "clean": state,
@@ -85,5 +363,8 @@ class RustPlugin(BasePlugin):
             "format": state,
             "tidy": state,
             "bench": state,
+            "analyze": state,
+            "pgo": state,
+            "profile": state,
             "generate": PluginSupport.NOT_ENABLED_BY_DEFAULT,
         }
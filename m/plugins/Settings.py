@@ -1,6 +1,7 @@
 import typing
+from multiprocessing import cpu_count
 from pathlib import Path
-from subprocess import run
+from .Process import run
 from .Base import plugin, BasePlugin, PluginSupport, Setting
 
 
@@ -37,11 +38,23 @@ class Settings(BasePlugin):
         else:
             return None
 
+    @staticmethod
+    def side_build_dir(settings, variant):
+        """returns a build directory next to build_dir for a variant of the build"""
+        build_dir = settings["build_dir"].value
+        return build_dir.with_name(f"{build_dir.name}_{variant}")
+
     def settings(self, current_settings) -> typing.List[Setting]:
         """returns settings that this plugin is authoritative for"""
         make_setting = self.get_settings_factory(priority=Setting.LOW)
         return [
             make_setting("repo_base", self.find_repo_base()),
             make_setting("build_dir", self.find_build_dir()),
+            make_setting("release", False),
+            make_setting("jobs", cpu_count()),
+            make_setting("eta", True),
+            make_setting("format_base", "HEAD"),
+            make_setting("pgo_train", []),
+            make_setting("llvm_profdata", "llvm-profdata"),
             *super().settings(current_settings),
         ]
@@ -1,13 +1,84 @@
+import logging
 import typing
 from pathlib import Path
-from subprocess import run, DEVNULL
+from .Process import run, PIPE, DEVNULL
 from .Base import plugin, BasePlugin, PluginSupport, Setting
+from .Settings import Settings
+from .Cache import state_dir, user_cache_dir, digest_files, load_json, store_json
+
+LOGGER = logging.getLogger(__name__)
+
+MIRROR_NAME = "m-local"
 
 
 @plugin
 class Spack(BasePlugin):
+    def settings(self, current_settings) -> typing.List[Setting]:
+        """returns settings that this plugin is authoritative for"""
+        make_setting = self.get_settings_factory(priority=Setting.LOW)
+        return [
+            make_setting("spack_mirror", user_cache_dir("spack-mirror")),
+        ]
+
     def build(self, settings):
-        return run(["spack", "install"]).returncode
+        """installs the spack environment unless it is unchanged since the last install"""
+        repo_base = settings["repo_base"].value
+        state_path = state_dir(settings) / "spack.json"
+        state = load_json(state_path, {})
+        if state.get("fingerprint") == self.fingerprint(settings):
+            LOGGER.info("spack environment is unchanged, skipping spack install")
+            return 0
+
+        spack = ["spack", "-D", str(repo_base), "-C", str(self.mirror_scope(settings))]
+        result = run(
+            [
+                *spack,
+                "install",
+                "-j",
+                str(settings["jobs"].value),
+            ],
+            cwd=repo_base,
+        )
+        if result.returncode != 0:
+            return result.returncode
+
+        push = run(
+            [*spack, "buildcache", "push", "--unsigned", "--update-index", MIRROR_NAME],
+            cwd=repo_base,
+            stdout=DEVNULL,
+        )
+        if push.returncode != 0:
+            LOGGER.warning("failed to push the environment to %s", MIRROR_NAME)
+        # installing concretizes the environment and can rewrite spack.lock
+        store_json(state_path, {"fingerprint": self.fingerprint(settings)})
+        return 0
+
+    @staticmethod
+    def fingerprint(settings):
+        """hashes the environment's manifest, lock file and the spack version"""
+        repo_base = settings["repo_base"].value
+        version = run(["spack", "--version"], stdout=PIPE, universal_newlines=True)
+        files = [repo_base / "spack.yaml", repo_base / "spack.lock"]
+        return digest_files(
+            [path for path in files if path.exists()],
+            extra=[version.stdout, str(settings["spack_mirror"].value)],
+        )
+
+    @staticmethod
+    def mirror_scope(settings):
+        """returns a configuration scope that adds the local binary mirror; only its
+        packages, which m pushed unsigned, skip the signature check"""
+        mirror = Path(settings["spack_mirror"].value)
+        mirror.mkdir(parents=True, exist_ok=True)
+        scope = state_dir(settings, "spack_scope")
+        with open(scope / "mirrors.yaml", "w") as outfile:
+            outfile.write(
+                "mirrors:\n"
+                f"  {MIRROR_NAME}:\n"
+                f"    url: file://{mirror.resolve()}\n"
+                "    signed: false\n"
+            )
+        return scope
 
     @staticmethod
     def _supported(settings):
@@ -25,6 +96,12 @@ class Spack(BasePlugin):
             state = PluginSupport.DEFAULT_BEFORE_MAIN
         else:
             state = PluginSupport.NOT_ENABLED_BY_REPOSITORY
+
+        if (Settings.find_repo_base() / "spack.yaml").exists():
+            settings_state = PluginSupport.DEFAULT_AFTER_MAIN
+        else:
+            settings_state = PluginSupport.NOT_ENABLED_BY_REPOSITORY
         return {
+            "settings": settings_state,
             "build": state,
         }
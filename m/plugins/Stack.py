@@ -1,26 +1,153 @@
-from subprocess import run
+from .Process import run, Popen, PIPE
 from pathlib import Path
-from .Base import plugin, BasePlugin, PluginSupport
+from .Base import plugin, BasePlugin, PluginSupport, Setting
+from .Settings import Settings
 from os import execvp, chdir
+import logging
+import os
 import re
+import shutil
+import time
+import typing
+
+LOGGER = logging.getLogger(__name__)
+
+SOURCE_SUFFIXES = {".hs", ".lhs", ".hsc", ".hs-boot"}
+CONFIG_SUFFIXES = {".cabal", ".yaml"}
+IGNORED_DIRS = {".stack-work", ".git", "dist-newstyle"}
+POLL_INTERVAL = 0.5
+
+
+def _snapshot(repo_base):
+    """returns the modification times of the haskell sources and package descriptions"""
+    mtimes = {}
+    for root, dirs, files in os.walk(repo_base):
+        dirs[:] = [d for d in dirs if d not in IGNORED_DIRS]
+        for name in files:
+            path = Path(root, name)
+            if path.suffix in SOURCE_SUFFIXES or path.suffix in CONFIG_SUFFIXES:
+                try:
+                    mtimes[path] = path.stat().st_mtime_ns
+                except OSError:
+                    continue
+    return mtimes
 
 
 @plugin
 class HaskellStackPlugin(BasePlugin):
+    def settings(self, current_settings) -> typing.List[Setting]:
+        """returns settings that this plugin is authoritative for"""
+        make_setting = self.get_settings_factory(priority=Setting.LOW)
+        return [
+            make_setting("stack_fast", True),
+        ]
+
+    @staticmethod
+    def dev_args(settings):
+        """returns the arguments that make stack build quickly for development: no
+        optimization and GHC compiling modules in parallel"""
+        if not settings["stack_fast"].value:
+            return []
+        jobs = settings["jobs"].value
+        return ["--fast", "-j", str(jobs), f"--ghc-options=-j{jobs}"]
+
     def build(self, settings):
         """compiles the source code or a subset thereof"""
         return run(
-            ["stack-bin", "build", *settings["cmdline_build"].value],
+            [
+                "stack-bin",
+                "build",
+                *self.dev_args(settings),
+                *settings["cmdline_build"].value,
+            ],
             cwd=settings["repo_base"].value,
         ).returncode
 
     def test(self, settings):
-        """runs automated tests on source code or a subset there of"""
+        """runs automated tests on source code or a subset there of
+
+        m t -c watch [TARGET] -- keeps ghci running and re-runs the test suite when a
+                                 source file changes
+        """
+        args = settings["cmdline_test"].value
+        if args and args[0] == "watch":
+            return self.watch(settings, args[1:])
         return run(
-            ["stack-bin", "test", *settings["cmdline_test"].value],
+            ["stack-bin", "test", *self.dev_args(settings), *args],
             cwd=settings["repo_base"].value,
         ).returncode
 
+    @staticmethod
+    def test_target(settings):
+        """returns the first test suite stack knows about"""
+        result = run(
+            ["stack-bin", "ide", "targets"],
+            cwd=settings["repo_base"].value,
+            stdout=PIPE,
+            stderr=PIPE,
+            universal_newlines=True,
+        )
+        for line in (result.stdout + result.stderr).splitlines():
+            if ":test:" in line:
+                return line.strip()
+        return None
+
+    def watch(self, settings, targets):
+        """reloads changed modules in a resident ghci and runs the test suite's main
+        after every change, restarting ghci when a package description changes"""
+        repo_base = settings["repo_base"].value
+        if not targets:
+            target = self.test_target(settings)
+            targets = [target] if target else []
+        jobs = settings["jobs"].value
+        ghci = [
+            "stack-bin",
+            "ghci",
+            *targets,
+            f"--ghci-options=-j{jobs}",
+        ]
+        if shutil.which("ghcid"):
+            chdir(repo_base)
+            args = ["ghcid", f"--command={' '.join(ghci)}", "--test=:main"]
+            execvp(args[0], args)
+
+        proc = None
+        snapshot = {}
+        try:
+            while True:
+                current = _snapshot(repo_base)
+                changed = {
+                    path
+                    for path in current.keys() | snapshot.keys()
+                    if current.get(path) != snapshot.get(path)
+                }
+                if (
+                    proc is None
+                    or proc.poll() is not None
+                    or any(
+                        path.suffix in CONFIG_SUFFIXES for path in changed if snapshot
+                    )
+                ):
+                    if proc is not None and proc.poll() is None:
+                        proc.terminate()
+                        proc.wait()
+                    LOGGER.info("starting %s", " ".join(ghci))
+                    proc = Popen(
+                        ghci, cwd=repo_base, stdin=PIPE, universal_newlines=True
+                    )
+                    proc.stdin.write(":main\n")
+                    proc.stdin.flush()
+                elif changed:
+                    proc.stdin.write(":reload\n:main\n")
+                    proc.stdin.flush()
+                snapshot = current
+                time.sleep(POLL_INTERVAL)
+        finally:
+            if proc is not None and proc.poll() is None:
+                proc.terminate()
+                proc.wait()
+        return 0
+
     def clean(self, settings):
         """cleans source code or a subset there of"""
         return run(
@@ -66,7 +193,7 @@ class HaskellStackPlugin(BasePlugin):
     def bench(self, settings):
         """runs the binary"""
         return run(
-            ["stack-bin", "bench", *settings["cmdline_run"].value],
+            ["stack-bin", "bench", *settings["cmdline_bench"].value],
             cwd=settings["repo_base"].value,
         ).returncode
 
@@ -81,12 +208,19 @@ class HaskellStackPlugin(BasePlugin):
         else:
             state = PluginSupport.NOT_ENABLED_BY_REPOSITORY
 
+        if (Settings.find_repo_base() / "stack.yaml").exists():
+            settings_state = PluginSupport.DEFAULT_AFTER_MAIN
+        else:
+            settings_state = PluginSupport.NOT_ENABLED_BY_REPOSITORY
+
         return {
+            "settings": settings_state,
             "build": state,
             "test": state,
             "run": state,
             "repl": state,
             "clean": state,
             "install": state,
+            "bench": state,
             "generate": PluginSupport.NOT_ENABLED_BY_DEFAULT,
         }
@@ -0,0 +1,98 @@
+import statistics
+import typing
+from collections import defaultdict
+from .Base import plugin, BasePlugin, PluginSupport, Setting
+from . import Process
+
+# runs compared against the runs before them to compute the trend
+TREND_RUNS = 5
+
+
+def _trend(values):
+    """returns the change of the median of the latest runs over the runs before"""
+    if len(values) < 2 * TREND_RUNS:
+        return None
+    before = statistics.median(values[-2 * TREND_RUNS : -TREND_RUNS])
+    latest = statistics.median(values[-TREND_RUNS:])
+    return (latest - before) / before if before else None
+
+
+def summarize(entries):
+    """returns a row per repository, mode and build directory of the history"""
+    groups = defaultdict(list)
+    for entry in entries:
+        groups[(entry["repo"], entry["mode"], entry["build_dir"])].append(entry)
+    rows = []
+    for (repo, mode, build_dir), runs in groups.items():
+        walls = [run["wall"] for run in runs]
+        cpus = [run["utime"] + run["stime"] for run in runs]
+        rows.append(
+            {
+                "repo": repo,
+                "mode": mode,
+                "build_dir": build_dir,
+                "runs": len(runs),
+                "failed": sum(1 for run in runs if run["rc"]),
+                "wall": statistics.median(walls),
+                "cpu": statistics.median(cpus),
+                "maxrss_mb": max(run["maxrss"] for run in runs) / 1024,
+                "io_mb": statistics.median(
+                    (run["inblock"] + run["oublock"]) * 512 / 2**20 for run in runs
+                ),
+                "trend": _trend(walls),
+                "last": runs[-1]["t"],
+            }
+        )
+    return sorted(rows, key=lambda row: -row["last"])
+
+
+def print_summary(rows, show_repo):
+    """prints the rows of summarize, grouped by repository if show_repo"""
+    print(
+        f"{'mode':10} {'runs':>5} {'wall':>8} {'cpu':>8} {'rss MB':>8} {'io MB':>8}"
+        f" {'trend':>7}  build dir"
+    )
+    repo = None
+    if show_repo:
+        rows = sorted(rows, key=lambda row: row["repo"])
+    for row in rows:
+        if show_repo and row["repo"] != repo:
+            repo = row["repo"]
+            print(repo)
+        trend = "" if row["trend"] is None else f"{row['trend']:+.0%}"
+        runs = f"{row['runs']}" + (f"/{row['failed']}!" if row["failed"] else "")
+        print(
+            f"{row['mode']:10} {runs:>5} {row['wall']:7.1f}s {row['cpu']:7.1f}s"
+            f" {row['maxrss_mb']:8.0f} {row['io_mb']:8.0f} {trend:>7}"
+            f"  {row['build_dir']}"
+        )
+
+
+@plugin
+class Stats(BasePlugin):
+    def settings(self, current_settings) -> typing.List[Setting]:
+        """returns settings that this plugin is authoritative for"""
+        make_setting = self.get_settings_factory(priority=Setting.LOW)
+        return [make_setting("stats", True)]
+
+    def stats(self, settings):
+        """prints the median wall and cpu time, peak memory and block io of the
+        recorded m actions and how the wall time of the latest runs changed"""
+        entries = Process.load_history()
+        show_all = "all" in settings["cmdline_stats"].value
+        if not show_all:
+            repo = str(settings["repo_base"].value)
+            entries = [entry for entry in entries if entry["repo"] == repo]
+        if not entries:
+            print("m: no actions were recorded yet")
+            return 0
+        print_summary(summarize(entries), show_all)
+        return 0
+
+    @staticmethod
+    def _supported(settings):
+        """returns a dictionary of supported functions"""
+        return {
+            "settings": PluginSupport.DEFAULT_AFTER_MAIN,
+            "stats": PluginSupport.DEFAULT_MAIN,
+        }
@@ -0,0 +1,152 @@
+"""builds a julia sysimage for the project with PackageCompiler in the background"""
+
+import logging
+import os
+from .Process import run, Popen, PIPE, STDOUT, DEVNULL
+from jinja2 import Environment, PackageLoader
+from .Cache import user_cache_dir, digest_files, source_files, load_json, store_json
+
+try:
+    import tomllib
+except ImportError:  # python < 3.11
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+LOGGER = logging.getLogger(__name__)
+
+MODES = ("none", "deps", "project")
+
+
+def _project(repo_base):
+    """returns the parsed Project.toml of the repository"""
+    if tomllib is None:
+        LOGGER.warning("install tomli to read Project.toml, not building a sysimage")
+        return {}
+    with open(repo_base / "Project.toml", "rb") as infile:
+        return tomllib.load(infile)
+
+
+def project_name(repo_base):
+    """returns the name of the package the repository defines, if any"""
+    return _project(repo_base).get("name")
+
+
+def julia_version():
+    """returns the version string of the julia on the path"""
+    result = run(["julia", "--version"], stdout=PIPE, universal_newlines=True)
+    return result.stdout.strip()
+
+
+def _sysimage_dir(settings):
+    path = settings["build_dir"].value / "julia_sysimage"
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def image_contents(settings):
+    """returns the packages to compile into the sysimage and the key of the sysimage
+
+    in deps mode only the dependencies are compiled in, so the key only depends on the
+    environment and the julia version and edits to the project keep using the image.
+    in project mode the project itself is compiled in as well, so its sources are part
+    of the key.
+    """
+    mode = settings["julia_sysimage"].value
+    repo_base = settings["repo_base"].value
+    if mode not in MODES:
+        LOGGER.warning("unknown julia_sysimage mode %s", mode)
+        return [], None
+    if mode == "none":
+        return [], None
+    project = _project(repo_base)
+    packages = sorted(project.get("deps", {}))
+    files = [repo_base / "Project.toml", repo_base / "Manifest.toml"]
+    if mode == "project" and "name" in project:
+        packages.append(project["name"])
+        files.extend(source_files(repo_base, "src"))
+    if not packages:
+        return [], None
+    key = digest_files(
+        [path for path in files if path.exists()],
+        extra=[julia_version(), mode, *packages],
+    )
+    return packages, key[:16]
+
+
+def _building(lock_path, key):
+    """returns if a background build of key is still running"""
+    lock = load_json(lock_path, {})
+    if lock.get("key") != key:
+        return False
+    try:
+        os.kill(lock["pid"], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _tool_env():
+    """returns the shared environment that PackageCompiler is installed into"""
+    return user_cache_dir("julia", "packagecompiler")
+
+
+def _start_build(settings, packages, key):
+    """starts building the sysimage for key in a detached julia process"""
+    repo_base = settings["repo_base"].value
+    image_dir = _sysimage_dir(settings)
+    template_env = Environment(loader=PackageLoader("m", "templates"))
+    script = template_env.get_template("julia/sysimage.jl.j2").render(
+        tool_env=str(_tool_env()),
+        project=str(repo_base),
+        workload=str(repo_base / "test" / "runtests.jl"),
+        packages=packages,
+        partial=str(image_dir / f"{key}.partial.so"),
+        output=str(image_dir / f"{key}.so"),
+    )
+    script_path = image_dir / "sysimage.jl"
+    script_path.write_text(script)
+    with open(image_dir / "build.log", "w") as log:
+        proc = Popen(
+            ["julia", "--startup-file=no", str(script_path)],
+            cwd=repo_base,
+            stdin=DEVNULL,
+            stdout=log,
+            stderr=STDOUT,
+            start_new_session=True,
+        )
+    store_json(image_dir / "build.json", {"pid": proc.pid, "key": key})
+    print(
+        "m: building a julia sysimage in the background, see",
+        image_dir / "build.log",
+    )
+
+
+def sysimage(settings):
+    """returns the sysimage for the current project if it is up to date, starting a
+    background build if it is not"""
+    packages, key = image_contents(settings)
+    if key is None:
+        return None
+    image_dir = _sysimage_dir(settings)
+    image = image_dir / f"{key}.so"
+    if image.exists():
+        for stale in image_dir.glob("*.so"):
+            if stale != image and not stale.name.endswith(".partial.so"):
+                stale.unlink()
+        return image
+    if not _building(image_dir / "build.json", key):
+        _start_build(settings, packages, key)
+    return None
+
+
+def julia_args(settings):
+    """returns the julia arguments that load the project's sysimage, if it is ready"""
+    image = sysimage(settings)
+    if image is None:
+        return []
+    LOGGER.info("using sysimage %s", image)
+    return ["--sysimage", str(image)]
@@ -0,0 +1,171 @@
+"""aggregates clang -ftime-trace output into a project wide report"""
+
+import json
+import logging
+import os
+import re
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from .Process import run, PIPE, DEVNULL
+from .Cache import state_dir, load_json, store_json
+
+LOGGER = logging.getLogger(__name__)
+
+TOP_N = 20
+SKIPPED_DIRS = {".m", "meson-info", "meson-logs", "meson-private"}
+TEMPLATE_ARGS = re.compile(r"<.*>")
+
+CATEGORIES = {
+    "Source": "headers",
+    "InstantiateClass": "templates",
+    "InstantiateFunction": "templates",
+    "CodeGen Function": "functions",
+    "OptFunction": "functions",
+}
+
+
+def find_traces(side_dir):
+    """yields every json file in the build directory that might be a time trace"""
+    for root, dirs, files in os.walk(side_dir):
+        dirs[:] = [d for d in dirs if d not in SKIPPED_DIRS]
+        for name in files:
+            if name.endswith(".json") and name != "compile_commands.json":
+                yield os.path.join(root, name)
+
+
+def summarize_trace(path):
+    """summarizes a single translation unit's trace; runs in a worker process"""
+    with open(path) as infile:
+        if infile.read(32).lstrip()[:15] != '{"traceEvents":':
+            return None
+        infile.seek(0)
+        trace = json.load(infile)
+
+    summary = {"headers": {}, "templates": {}, "template_sets": {}, "functions": {}}
+    total = 0
+    for event in trace.get("traceEvents", []):
+        if event.get("ph") != "X":
+            continue
+        name = event.get("name")
+        duration = event.get("dur", 0)
+        if name == "ExecuteCompiler":
+            total += duration
+            continue
+        category = CATEGORIES.get(name)
+        if category is None:
+            continue
+        detail = event.get("args", {}).get("detail", "")
+        keys = [(category, detail)]
+        if category == "templates":
+            keys.append(("template_sets", TEMPLATE_ARGS.sub("<$>", detail)))
+        for key_category, key in keys:
+            count, time = summary[key_category].get(key, (0, 0))
+            summary[key_category][key] = (count + 1, time + duration)
+    summary["total_us"] = total
+    return summary
+
+
+def _demangle(names):
+    """demangles function names with c++filt when it is available"""
+    try:
+        result = run(
+            ["c++filt"],
+            input="\n".join(names),
+            stdout=PIPE,
+            stderr=DEVNULL,
+            universal_newlines=True,
+        )
+    except OSError:
+        return names
+    demangled = result.stdout.splitlines()
+    return demangled if len(demangled) == len(names) else names
+
+
+def aggregate(settings, side_dir):
+    """summarizes the traces that changed since the last run in parallel and merges
+    them with the cached summaries of the unchanged translation units"""
+    cache_path = state_dir(settings) / "timetrace.json"
+    cache = load_json(cache_path, {})
+    current = {}
+    stale = []
+    for path in find_traces(side_dir):
+        stat = os.stat(path)
+        key = [stat.st_mtime_ns, stat.st_size]
+        entry = cache.get(path)
+        if entry is not None and entry["key"] == key:
+            current[path] = entry
+        else:
+            current[path] = {"key": key, "summary": None}
+            stale.append(path)
+
+    LOGGER.info("summarizing %d of %d traces", len(stale), len(current))
+    if stale:
+        with ProcessPoolExecutor(max_workers=settings["jobs"].value) as pool:
+            chunksize = max(1, len(stale) // (4 * settings["jobs"].value))
+            for path, summary in zip(
+                stale, pool.map(summarize_trace, stale, chunksize=chunksize)
+            ):
+                current[path]["summary"] = summary
+    store_json(cache_path, current)
+
+    totals = defaultdict(lambda: defaultdict(lambda: [0, 0]))
+    units = []
+    for path, entry in current.items():
+        summary = entry["summary"]
+        if summary is None:
+            continue
+        units.append({"name": path, "us": summary["total_us"]})
+        for category in ("headers", "templates", "template_sets", "functions"):
+            for name, (count, time) in summary[category].items():
+                totals[category][name][0] += count
+                totals[category][name][1] += time
+
+    def ranked(items):
+        return sorted(
+            (
+                {"name": name, "count": count, "us": time}
+                for name, (count, time) in items
+            ),
+            key=lambda item: item["us"],
+            reverse=True,
+        )[:TOP_N]
+
+    report = {category: ranked(totals[category].items()) for category in totals}
+    report["units"] = sorted(units, key=lambda u: u["us"], reverse=True)[:TOP_N]
+    if report.get("functions"):
+        for item, name in zip(
+            report["functions"],
+            _demangle([f["name"] for f in report["functions"]]),
+        ):
+            item["name"] = name
+    return report
+
+
+def print_report(report):
+    """prints the ranked report"""
+    sections = (
+        ("units", "slowest translation units"),
+        ("headers", "most expensive headers (inclusive parse time)"),
+        ("template_sets", "most expensive template sets"),
+        ("templates", "most expensive template instantiations"),
+        ("functions", "most expensive functions to generate code for"),
+    )
+    for key, title in sections:
+        print(f"\n{title}:")
+        for item in report.get(key, []):
+            count = f"{item['count']:6d}x" if "count" in item else ""
+            print(f"{item['us'] / 1e6:8.2f}s", count, item["name"])
+
+
+def analyze(settings, side_dir):
+    """aggregates the traces in side_dir, prints and stores the report"""
+    report = aggregate(settings, side_dir)
+    if not report["units"]:
+        print("no time traces found in", side_dir, "is the compiler clang?")
+        return 1
+    print_report(report)
+    dest = side_dir / "m_timetrace.json"
+    with open(dest, "w") as outfile:
+        json.dump(report, outfile, indent=2)
+    print("\nreport written to", dest)
+    return 0
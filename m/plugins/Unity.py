@@ -0,0 +1,125 @@
+"""tunes the unity build batch size of each CMake target from the ninja build history"""
+
+import logging
+import math
+import re
+from collections import defaultdict
+from jinja2 import Environment, PackageLoader
+from . import BuildLog
+from .Cache import state_dir, load_json, store_json
+
+LOGGER = logging.getLogger(__name__)
+
+OBJECT = re.compile(
+    r"(?:^|/)CMakeFiles/(?P<target>[^/]+)\.dir/(?P<source>.+)\.(?:o|obj)$"
+)
+MIN_FILES = 2
+RETUNE_CHANGE = 0.2
+
+
+def per_file_times(totals):
+    """returns the mean compile time in ms of each source file of each target, leaving
+    out unity sources and precompiled headers since they cover several files"""
+    times = defaultdict(dict)
+    for name, (count, total) in totals.items():
+        match = OBJECT.search(name)
+        if match is None:
+            continue
+        source = match.group("source")
+        if source.startswith("Unity/") or "cmake_pch" in source:
+            continue
+        times[match.group("target")][source] = total / count
+    return times
+
+
+def unity_targets(totals):
+    """returns the targets that were built with unity sources"""
+    return {
+        match.group("target")
+        for match in map(OBJECT.search, totals)
+        if match is not None and match.group("source").startswith("Unity/")
+    }
+
+
+def pch_expression(header):
+    """returns the PRECOMPILE_HEADERS entry that uses header for C++ only; the > of
+    an angle bracket header would end the generator expression early"""
+    return "$<$<COMPILE_LANGUAGE:CXX>:{}>".format(header.replace(">", "$<ANGLE-R>"))
+
+
+def choose_batch(times, jobs, edit_weight):
+    """returns the batch size that minimizes a weighted sum of the full build time and
+    the time to rebuild after editing one file
+
+    each translation unit is modeled as a fixed overhead, estimated by the cheapest
+    file of the target, plus its own work.  a batch of b files pays the overhead once,
+    so larger batches shorten full builds but rebuild more work after each edit.
+    """
+    count = len(times)
+    overhead = min(times)
+    work = sum(times) - count * overhead
+    mean_work = work / count
+
+    def cost(batch):
+        batch_time = overhead + batch * mean_work
+        full = max((math.ceil(count / batch) * overhead + work) / jobs, batch_time)
+        return full + edit_weight * batch_time
+
+    return min(range(1, count + 1), key=cost)
+
+
+def tune(settings):
+    """updates the persisted batch sizes for targets without one or whose number of
+    files changed noticeably, keeping the others stable so that unity groupings and
+    therefore incremental builds are not disturbed"""
+    state_path = state_dir(settings) / "unity.json"
+    state = load_json(state_path, {"targets": {}})
+    history = BuildLog.update_ninja_history(settings)
+    jobs = settings["jobs"].value
+    edit_weight = settings["cmake_unity_edit_weight"].value
+    times_by_target = per_file_times(history["totals"])
+    # a build directory that started out with unity builds never timed single files
+    for target in unity_targets(history["totals"]) - times_by_target.keys():
+        if target not in state["targets"]:
+            LOGGER.info("building %s without unity once to time its files", target)
+            state["targets"][target] = {"batch": 1, "probe": True}
+    for target, sources in times_by_target.items():
+        if len(sources) < MIN_FILES:
+            continue
+        previous = state["targets"].get(target)
+        if (
+            previous is not None
+            and not previous.get("probe")
+            and abs(len(sources) - previous["files"])
+            <= RETUNE_CHANGE * previous["files"]
+        ):
+            continue
+        times = list(sources.values())
+        batch = choose_batch(times, jobs, edit_weight)
+        LOGGER.info("unity batch size for %s is %d", target, batch)
+        state["targets"][target] = {
+            "batch": batch,
+            "files": len(sources),
+            "overhead_ms": round(min(times)),
+            "total_ms": round(sum(times)),
+        }
+    state["pch"] = list(settings["cmake_pch"].value)
+    store_json(state_path, state)
+    return state
+
+
+def write_project_include(settings):
+    """writes the CMAKE_PROJECT_INCLUDE file that applies the tuned parameters and
+    returns its path; the file is only rewritten when it changes since cmake re-runs
+    whenever it does"""
+    state = tune(settings)
+    template_env = Environment(loader=PackageLoader("m", "templates"))
+    render = template_env.get_template("cpp/m_unity.cmake.j2").render(
+        state=state_dir(settings) / "unity.json",
+        batches={name: tuned["batch"] for name, tuned in state["targets"].items()},
+        pch=[pch_expression(header) for header in state["pch"]],
+    )
+    path = state_dir(settings) / "unity.cmake"
+    if not path.exists() or path.read_text() != render:
+        path.write_text(render)
+    return path
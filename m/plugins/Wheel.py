@@ -0,0 +1,143 @@
+"""builds python projects into wheels through PEP 517 and caches them by source tree"""
+
+import hashlib
+import json
+import logging
+import shutil
+import tempfile
+from pathlib import Path
+from .Process import run, PIPE
+from .Cache import user_cache_dir, digest_files, source_files
+
+try:
+    import tomllib
+except ImportError:  # python < 3.11
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+LOGGER = logging.getLogger(__name__)
+
+BYPRODUCTS = {"__pycache__", ".pytest_cache", ".mypy_cache"}
+DEFAULT_REQUIRES = ["setuptools>=40.8.0", "wheel"]
+INTERPRETER = (
+    "import json, sys, sysconfig; print(json.dumps([sys.implementation.cache_tag,"
+    " sysconfig.get_config_var('SOABI'), sysconfig.get_platform()]))"
+)
+
+
+def build_requires(repo_base):
+    """returns the build requirements declared in pyproject.toml"""
+    pyproject = repo_base / "pyproject.toml"
+    if not pyproject.exists():
+        return DEFAULT_REQUIRES
+    if tomllib is None:
+        LOGGER.warning(
+            "install tomli to read pyproject.toml, using the default build requirements"
+        )
+        return DEFAULT_REQUIRES
+    with open(pyproject, "rb") as infile:
+        data = tomllib.load(infile)
+    return data.get("build-system", {}).get("requires", DEFAULT_REQUIRES)
+
+
+def interpreter_abi(python):
+    """returns the cache tag, ABI and platform of the interpreter"""
+    result = run(
+        [*python, "-c", INTERPRETER], stdout=PIPE, universal_newlines=True, check=True
+    )
+    return json.loads(result.stdout)
+
+
+def build_env(python, requires, abi):
+    """returns the python of a build environment with requires installed, creating it
+    once and reusing it for every build with the same requirements and interpreter"""
+    key = hashlib.sha256(json.dumps([sorted(requires), abi]).encode()).hexdigest()
+    env_dir = user_cache_dir("pep517") / key[:16]
+    env_python = env_dir / "bin" / "python"
+    if (env_dir / ".ready").exists():
+        return env_python
+    shutil.rmtree(env_dir, ignore_errors=True)
+    if run([*python, "-m", "venv", str(env_dir)]).returncode != 0:
+        return None
+    result = run(
+        [str(env_python), "-m", "pip", "install", "--quiet", "build", *requires]
+    )
+    if result.returncode != 0:
+        return None
+    (env_dir / ".ready").touch()
+    return env_python
+
+
+def build_wheel(settings, python=("python",), extra=()):
+    """returns a wheel for the current source tree, building it only if no wheel was
+    cached for the same tree, interpreter ABI and arguments"""
+    repo_base = settings["repo_base"].value
+    build_dir = settings["build_dir"].value.resolve()
+    abi = interpreter_abi(python)
+    sources = [
+        path
+        for path in source_files(repo_base, ".")
+        if path.exists()
+        and build_dir not in path.resolve().parents
+        and not any(
+            part in BYPRODUCTS or part.endswith(".egg-info")
+            for part in path.relative_to(repo_base).parts
+        )
+    ]
+    key = digest_files(sources, extra=[*abi, *extra])
+    cache_dir = user_cache_dir("wheels", key[:32])
+    wheels = list(cache_dir.glob("*.whl"))
+    if wheels:
+        LOGGER.info("using cached wheel %s", wheels[0])
+        return wheels[0]
+
+    env_python = build_env(python, build_requires(repo_base), abi)
+    if env_python is None:
+        return None
+    with tempfile.TemporaryDirectory(dir=cache_dir.parent) as outdir:
+        result = run(
+            [
+                str(env_python),
+                "-m",
+                "build",
+                "--wheel",
+                "--no-isolation",
+                "--outdir",
+                outdir,
+                *extra,
+                str(repo_base),
+            ],
+            cwd=repo_base,
+        )
+        if result.returncode != 0:
+            return None
+        for wheel in Path(outdir).glob("*.whl"):
+            shutil.move(str(wheel), cache_dir / wheel.name)
+    wheels = list(cache_dir.glob("*.whl"))
+    return wheels[0] if wheels else None
+
+
+def install_wheel(settings, python=("python",), extra=(), build_extra=()):
+    """installs the cached wheel for the current source tree"""
+    wheel = build_wheel(settings, python, build_extra)
+    if wheel is None:
+        return 1
+    # the version usually does not change between builds, so force the project
+    # itself to be replaced and then let pip add any missing dependencies
+    result = run(
+        [
+            *python,
+            "-m",
+            "pip",
+            "install",
+            "--force-reinstall",
+            "--no-deps",
+            *extra,
+            str(wheel),
+        ]
+    )
+    if result.returncode != 0:
+        return result.returncode
+    return run([*python, "-m", "pip", "install", *extra, str(wheel)]).returncode
@@ -12,3 +12,4 @@ from . import Git
 from . import ConfigFile
 from . import Spack
 from . import Docker
+from . import Stats